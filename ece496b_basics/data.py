@@ -0,0 +1,618 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+
+import glob
+import os
+import queue
+import struct
+import threading
+import time
+from typing import NamedTuple, Optional
+
+import numpy as np
+import numpy.typing as npt
+import torch
+
+_MAGIC = b"TOK1"
+# Magic, NumPy dtype string (e.g. "<u2"), number of tokens. 16 bytes, so the token
+# array that follows is aligned for any token dtype.
+_HEADER = struct.Struct("<4s4sQ")
+_DTYPES = {np.dtype("<u2"), np.dtype("<u4")}
+
+
+def write_token_file(path: str | os.PathLike, tokens: npt.ArrayLike) -> None:
+    """Write token ids to `path` as a header followed by the raw ids.
+
+    The ids are stored as little-endian uint16 if they all fit, else as uint32, and
+    the header records which, so `TokenDataset` can map the file without being told
+    the dtype.
+    """
+    tokens = np.asarray(tokens)
+    fits_uint16 = tokens.size == 0 or tokens.max() < 2**16
+    dtype = np.dtype("<u2" if fits_uint16 else "<u4")
+    tmp_path = f"{os.fspath(path)}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(_HEADER.pack(_MAGIC, dtype.str.encode("ascii"), tokens.size))
+        f.write(tokens.astype(dtype, copy=False).tobytes())
+    os.replace(tmp_path, path)
+
+
+class EpochSampler:
+    """Deterministic sampler of non-overlapping windows, for `get_batch`.
+
+    The dataset is cut into `(num_tokens - 1) // context_length` windows, window `i`
+    starting at token `i * context_length`. Each epoch visits every window exactly
+    once, in the order of a permutation seeded by `(seed, epoch)`, and batches run
+    on into the next epoch when one ends. The position `(seed, epoch, offset)` is
+    all the state there is, so `state_dict` / `load_state_dict` let a resumed run see
+    exactly the batches an uninterrupted run would have seen.
+
+    Args:
+        num_tokens: int
+            Length of the dataset.
+        context_length: int
+            Length of each sampled sequence.
+        seed: int, default is 0
+            Seed of the per-epoch permutations.
+    """
+
+    def __init__(self, num_tokens: int, context_length: int, seed: int = 0):
+        self.num_tokens = num_tokens
+        self.context_length = context_length
+        self.num_windows = (num_tokens - 1) // context_length
+        if self.num_windows <= 0:
+            raise ValueError(
+                f"Dataset of {num_tokens} tokens is too short for context length "
+                f"{context_length}"
+            )
+        self.seed = seed
+        self.epoch = 0
+        self.offset = 0
+        self._order = self._permutation(self.epoch)
+
+    def _permutation(self, epoch: int) -> np.ndarray:
+        rng = np.random.default_rng((self.seed, epoch))
+        return rng.permutation(self.num_windows)
+
+    def next_starts(self, batch_size: int) -> np.ndarray:
+        """Start indices of the next `batch_size` windows; advances the position."""
+        parts = []
+        while batch_size > 0:
+            take = min(batch_size, self.num_windows - self.offset)
+            parts.append(self._order[self.offset : self.offset + take])
+            self.offset += take
+            batch_size -= take
+            if self.offset == self.num_windows:
+                self.epoch += 1
+                self.offset = 0
+                self._order = self._permutation(self.epoch)
+        return np.concatenate(parts) * self.context_length
+
+    def state_dict(self) -> dict:
+        return {
+            "seed": self.seed,
+            "epoch": self.epoch,
+            "offset": self.offset,
+            "num_windows": self.num_windows,
+        }
+
+    def load_state_dict(self, state: dict) -> None:
+        """Restore the position saved by `state_dict`.
+
+        Raises:
+            ValueError: if the state was saved for a different number of windows.
+        """
+        if state["num_windows"] != self.num_windows:
+            raise ValueError(
+                f"Sampler state has {state['num_windows']} windows, "
+                f"but this sampler has {self.num_windows}"
+            )
+        self.seed = state["seed"]
+        self.epoch = state["epoch"]
+        self.offset = state["offset"]
+        self._order = self._permutation(self.epoch)
+
+
+def _sample_starts(
+    num_tokens: int,
+    batch_size: int,
+    context_length: int,
+    rng: Optional[np.random.Generator],
+    sampler: Optional[EpochSampler] = None,
+) -> np.ndarray:
+    num_starts = num_tokens - context_length
+    if num_starts <= 0:
+        raise ValueError(
+            f"Dataset of {num_tokens} tokens is too short for context length "
+            f"{context_length}"
+        )
+    if sampler is not None:
+        if (sampler.num_tokens, sampler.context_length) != (
+            num_tokens,
+            context_length,
+        ):
+            raise ValueError(
+                f"Sampler is for {sampler.num_tokens} tokens and context length "
+                f"{sampler.context_length}, not {num_tokens} and {context_length}"
+            )
+        return sampler.next_starts(batch_size)
+    if rng is None:
+        return np.random.randint(0, num_starts, size=batch_size)
+    return rng.integers(0, num_starts, size=batch_size)
+
+
+def _gather_windows(
+    dataset: npt.NDArray, starts: np.ndarray, context_length: int
+) -> torch.Tensor:
+    """(len(starts), context_length + 1) int64 CPU tensor of the windows at `starts`."""
+    windows = np.lib.stride_tricks.sliding_window_view(dataset, context_length + 1)
+    return torch.from_numpy(windows[starts].astype(np.int64))
+
+
+def _sample_windows(
+    dataset: npt.NDArray,
+    batch_size: int,
+    context_length: int,
+    rng: Optional[np.random.Generator],
+    sampler: Optional[EpochSampler] = None,
+) -> torch.Tensor:
+    """(batch_size, context_length + 1) int64 CPU tensor of sampled windows."""
+    starts = _sample_starts(len(dataset), batch_size, context_length, rng, sampler)
+    return _gather_windows(dataset, starts, context_length)
+
+
+def get_batch(
+    dataset: npt.NDArray,
+    batch_size: int,
+    context_length: int,
+    device: str,
+    rng: Optional[np.random.Generator] = None,
+    sampler: Optional[EpochSampler] = None,
+) -> tuple[torch.Tensor, torch.Tensor]:
+    """Sample `batch_size` windows of `context_length + 1` tokens and split them into
+    inputs and next-token labels.
+
+    By default the start indices are drawn uniformly at random (with replacement).
+    With a `sampler`, the next windows of its seeded epoch order are taken instead.
+    All windows are gathered with one fancy-indexing operation over a strided view of
+    `dataset`, so for a memory-mapped dataset only the sampled pages are read.
+
+    Args:
+        dataset: npt.NDArray
+            1D array of token ids. May be a `np.memmap`.
+        batch_size: int
+            Number of sequences to sample.
+        context_length: int
+            Length of each sampled sequence.
+        device: str
+            PyTorch device to place the batch on.
+        rng: Optional[np.random.Generator]
+            Source of the random start indices. Defaults to NumPy's global random
+            state. Ignored if `sampler` is given.
+        sampler: Optional[EpochSampler]
+            Deterministic, resumable sampler built for `len(dataset)` tokens and
+            `context_length`.
+
+    Returns:
+        Tuple of torch.LongTensors (inputs, labels) of shape (batch_size, context_length).
+    """
+    batch = _sample_windows(dataset, batch_size, context_length, rng, sampler)
+    batch = batch.to(device)
+    return batch[:, :-1], batch[:, 1:]
+
+
+class DocumentIndex:
+    """Positions of the end-of-text tokens in a token array, which separate the
+    packed documents.
+
+    The index is built once, scanning the (possibly memory-mapped) tokens in chunks
+    of `chunk_size` so memory use stays bounded, and afterwards maps any window of
+    the dataset to per-token document ids with a binary search.
+
+    Args:
+        dataset: npt.NDArray
+            1D array of token ids. May be a `np.memmap`.
+        eot_id: int
+            Id of the token that ends a document, e.g. `<|endoftext|>`.
+        chunk_size: int, default is 2**24
+            Number of tokens scanned at a time while building the index.
+    """
+
+    def __init__(self, dataset: npt.NDArray, eot_id: int, chunk_size: int = 2**24):
+        self.num_tokens = len(dataset)
+        self.eot_id = eot_id
+        self.eot_positions = np.concatenate(
+            [
+                np.flatnonzero(dataset[start : start + chunk_size] == eot_id) + start
+                for start in range(0, self.num_tokens, chunk_size)
+            ]
+            or [np.zeros(0, dtype=np.int64)]
+        )
+
+    @property
+    def num_documents(self) -> int:
+        last_is_eot = (
+            len(self.eot_positions) > 0
+            and self.eot_positions[-1] == self.num_tokens - 1
+        )
+        return len(self.eot_positions) + (0 if last_is_eot else 1)
+
+    def segment_ids(self, starts: np.ndarray, length: int) -> np.ndarray:
+        """(len(starts), length) document ids of the tokens in the windows at
+        `starts`, numbered from 0 in each window. An end-of-text token belongs to the
+        document it ends."""
+        positions = np.asarray(starts)[:, None] + np.arange(length)
+        documents = np.searchsorted(self.eot_positions, positions, side="left")
+        return documents - documents[:, :1]
+
+
+class PackingStats(NamedTuple):
+    """How well a batch of packed sequences uses compute.
+
+    `documents` counts document pieces (a document cut by a window boundary counts
+    once per window). `cross_document_pairs` is the number of causal (query, key)
+    pairs that cross documents, which the block-diagonal mask removes.
+    """
+
+    sequences: int
+    seq_len: int
+    documents: int
+    cross_document_pairs: int
+
+    @property
+    def tokens(self) -> int:
+        return self.sequences * self.seq_len
+
+    @property
+    def causal_pairs(self) -> int:
+        return self.sequences * self.seq_len * (self.seq_len + 1) // 2
+
+    @property
+    def cross_document_fraction(self) -> float:
+        """Fraction of causal attention pairs avoided by the block-diagonal mask."""
+        return self.cross_document_pairs / self.causal_pairs if self.tokens else 0.0
+
+    @property
+    def padding_efficiency(self) -> float:
+        """Tokens per step relative to giving every document piece its own padded
+        sequence, i.e., the fraction of non-padding tokens without packing."""
+        return self.tokens / (self.documents * self.seq_len) if self.tokens else 0.0
+
+
+def packing_stats(segment_ids: torch.Tensor | np.ndarray) -> PackingStats:
+    """Compute `PackingStats` from the (batch_size, seq_len) segment ids of a batch."""
+    segment_ids = torch.as_tensor(segment_ids).cpu()
+    batch_size, seq_len = segment_ids.shape
+    # Length of every document piece, from which the within-document pairs follow.
+    lengths = torch.zeros(batch_size, seq_len, dtype=torch.long)
+    lengths.scatter_add_(1, segment_ids, torch.ones_like(lengths))
+    same_document_pairs = int((lengths * (lengths + 1) // 2).sum())
+    stats = PackingStats(
+        sequences=batch_size,
+        seq_len=seq_len,
+        documents=int((lengths > 0).sum()),
+        cross_document_pairs=0,
+    )
+    return stats._replace(cross_document_pairs=stats.causal_pairs - same_document_pairs)
+
+
+def get_packed_batch(
+    dataset: npt.NDArray,
+    batch_size: int,
+    context_length: int,
+    device: str,
+    document_index: DocumentIndex,
+    rng: Optional[np.random.Generator] = None,
+    sampler: Optional[EpochSampler] = None,
+) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """Like `get_batch`, but also return the document id of every input token.
+
+    Passing the segment ids to the model (e.g. `MultiHeadSelfAttention`) makes
+    attention block-diagonal causal, so no token attends to an unrelated document
+    that happens to share its window.
+
+    Args:
+        dataset: npt.NDArray
+            1D array of token ids. May be a `np.memmap`.
+        batch_size: int
+            Number of sequences to sample.
+        context_length: int
+            Length of each sampled sequence.
+        device: str
+            PyTorch device to place the batch on.
+        document_index: DocumentIndex
+            Index of the document boundaries of `dataset`.
+        rng: Optional[np.random.Generator]
+            See `get_batch`.
+        sampler: Optional[EpochSampler]
+            See `get_batch`.
+
+    Returns:
+        Tuple of torch.LongTensors (inputs, labels, segment_ids), each of shape
+        (batch_size, context_length).
+    """
+    if document_index.num_tokens != len(dataset):
+        raise ValueError("Document index was built for a different dataset")
+    starts = _sample_starts(len(dataset), batch_size, context_length, rng, sampler)
+    batch = _gather_windows(dataset, starts, context_length).to(device)
+    segment_ids = torch.from_numpy(document_index.segment_ids(starts, context_length))
+    return batch[:, :-1], batch[:, 1:], segment_ids.to(device)
+
+
+class TokenDataset:
+    """Token ids on disk, memory-mapped read-only so that datasets larger than RAM
+    can be sampled from.
+
+    Three file formats are accepted: files written by `write_token_file` (the dtype
+    is read from the header), `.npy` files (e.g. from `Tokenizer.encode_file`), and
+    raw token files, for which `dtype` must be given.
+
+    Args:
+        path: str | os.PathLike
+            Path to the token file.
+        dtype: Optional[npt.DTypeLike]
+            Dtype of a raw token file without header. Ignored for the other formats.
+    """
+
+    def __init__(self, path: str | os.PathLike, dtype: Optional[npt.DTypeLike] = None):
+        self.path = os.fspath(path)
+        with open(self.path, "rb") as f:
+            header = f.read(_HEADER.size)
+        if len(header) == _HEADER.size and header[:4] == _MAGIC:
+            _, dtype_str, num_tokens = _HEADER.unpack(header)
+            token_dtype = np.dtype(dtype_str.rstrip(b"\0").decode("ascii"))
+            if token_dtype not in _DTYPES:
+                raise ValueError(f"Unsupported token dtype {token_dtype} in {path}")
+            self.tokens = np.memmap(
+                self.path,
+                dtype=token_dtype,
+                mode="r",
+                offset=_HEADER.size,
+                shape=(num_tokens,),
+            )
+        elif self.path.endswith(".npy"):
+            self.tokens = np.load(self.path, mmap_mode="r")
+        elif dtype is not None:
+            self.tokens = np.memmap(self.path, dtype=dtype, mode="r")
+        else:
+            raise ValueError(
+                f"{path} has no token file header; pass the dtype of the raw tokens"
+            )
+
+    @property
+    def dtype(self) -> np.dtype:
+        return self.tokens.dtype
+
+    def __len__(self) -> int:
+        return len(self.tokens)
+
+    def get_batch(
+        self,
+        batch_size: int,
+        context_length: int,
+        device: str,
+        rng: Optional[np.random.Generator] = None,
+        sampler: Optional[EpochSampler] = None,
+    ) -> tuple[torch.Tensor, torch.Tensor]:
+        """See `get_batch`."""
+        return get_batch(self.tokens, batch_size, context_length, device, rng, sampler)
+
+
+class LoaderStats(NamedTuple):
+    batches: int
+    starved: int
+    wait_seconds: float
+
+    @property
+    def starvation_rate(self) -> float:
+        """Fraction of batches the consumer had to wait for."""
+        return self.starved / self.batches if self.batches else 0.0
+
+
+class PrefetchLoader:
+    """Endless iterator of `get_batch` batches, sampled ahead of time by a background
+    thread.
+
+    Up to `prefetch` sampled batches wait in a bounded queue, so the gather from the
+    (possibly memory-mapped) dataset overlaps the training step. For CUDA devices the
+    batches are staged in pinned memory and copied with `non_blocking=True`, so the
+    host-to-device copy overlaps compute as well. `stats()` reports how often the
+    training loop found the queue empty; a high starvation rate means data loading
+    is the bottleneck.
+
+    Use as a context manager, or call `close()` to stop the background thread.
+
+    Args:
+        dataset: npt.NDArray
+            1D array of token ids. May be a `np.memmap`.
+        batch_size: int
+            Number of sequences per batch.
+        context_length: int
+            Length of each sequence.
+        device: str
+            PyTorch device to place the batches on.
+        prefetch: int, default is 4
+            Maximum number of batches sampled ahead.
+        rng: Optional[np.random.Generator]
+            Source of the start indices, used only by the background thread.
+            Defaults to a freshly seeded generator.
+    """
+
+    def __init__(
+        self,
+        dataset: npt.NDArray,
+        batch_size: int,
+        context_length: int,
+        device: str,
+        prefetch: int = 4,
+        rng: Optional[np.random.Generator] = None,
+    ):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.context_length = context_length
+        self.device = torch.device(device)
+        self.rng = rng if rng is not None else np.random.default_rng()
+        self._pin_memory = self.device.type == "cuda"
+        self._queue: queue.Queue = queue.Queue(maxsize=prefetch)
+        self._stop = threading.Event()
+        self._batches = 0
+        self._starved = 0
+        self._wait_seconds = 0.0
+        self._thread = threading.Thread(target=self._produce, daemon=True)
+        self._thread.start()
+
+    def _produce(self) -> None:
+        try:
+            while not self._stop.is_set():
+                batch = _sample_windows(
+                    self.dataset, self.batch_size, self.context_length, self.rng
+                )
+                if self._pin_memory:
+                    batch = batch.pin_memory()
+                self._put(batch)
+        except BaseException as e:
+            self._put(e)
+
+    def _put(self, item) -> None:
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def __iter__(self) -> "PrefetchLoader":
+        return self
+
+    def __next__(self) -> tuple[torch.Tensor, torch.Tensor]:
+        if self._stop.is_set():
+            raise StopIteration
+        try:
+            batch = self._queue.get_nowait()
+        except queue.Empty:
+            self._starved += 1
+            start = time.perf_counter()
+            batch = self._queue.get()
+            self._wait_seconds += time.perf_counter() - start
+        if isinstance(batch, BaseException):
+            self.close()
+            raise batch
+        self._batches += 1
+        batch = batch.to(self.device, non_blocking=self._pin_memory)
+        return batch[:, :-1], batch[:, 1:]
+
+    def stats(self) -> LoaderStats:
+        return LoaderStats(self._batches, self._starved, self._wait_seconds)
+
+    def close(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def __enter__(self) -> "PrefetchLoader":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+class ShardedCorpus:
+    """Weighted mixture of token sources, each made of one or more memory-mapped
+    shard files (see `TokenDataset`).
+
+    The shard lengths are read once when the corpus is opened; sampling draws the
+    source of every sequence according to the mixture weights, then a start index
+    uniformly over all windows of that source's shards, and gathers the windows
+    shard by shard. No shard is ever read into RAM as a whole. The number of tokens
+    drawn from each source is kept in `tokens_consumed` for logging.
+
+    Args:
+        sources: dict[str, str | list[str | os.PathLike]]
+            Maps a source name to its shard paths, or to a glob pattern matching them.
+        weights: Optional[dict[str, float]]
+            Mixture weight of each source; normalized to sum to 1. Defaults to the
+            sources' token counts, i.e., sampling uniformly over all tokens.
+        dtype: Optional[npt.DTypeLike]
+            Dtype of raw shard files without header (see `TokenDataset`).
+        rng: Optional[np.random.Generator]
+            Source of randomness for sampling. Defaults to a freshly seeded generator.
+    """
+
+    def __init__(
+        self,
+        sources: dict[str, str | list[str | os.PathLike]],
+        weights: Optional[dict[str, float]] = None,
+        dtype: Optional[npt.DTypeLike] = None,
+        rng: Optional[np.random.Generator] = None,
+    ):
+        self.source_names = list(sources)
+        self.shards: list[TokenDataset] = []
+        shard_sources = []
+        for source_id, name in enumerate(self.source_names):
+            paths = sources[name]
+            if isinstance(paths, str):
+                paths = sorted(glob.glob(paths))
+            if not paths:
+                raise ValueError(f"Source {name!r} has no shards")
+            for path in paths:
+                self.shards.append(TokenDataset(path, dtype=dtype))
+                shard_sources.append(source_id)
+        self.shard_sources = np.array(shard_sources)
+        self.shard_lengths = np.array([len(shard) for shard in self.shards])
+        source_tokens = np.bincount(
+            self.shard_sources,
+            weights=self.shard_lengths,
+            minlength=len(self.source_names),
+        )
+        if weights is None:
+            mixture = source_tokens
+        else:
+            mixture = np.array([weights.get(name, 0.0) for name in self.source_names])
+        self.weights = mixture / mixture.sum()
+        self.rng = rng if rng is not None else np.random.default_rng()
+        self.tokens_consumed = {name: 0 for name in self.source_names}
+
+    def __len__(self) -> int:
+        return int(self.shard_lengths.sum())
+
+    def get_batch(
+        self, batch_size: int, context_length: int, device: str
+    ) -> tuple[torch.Tensor, torch.Tensor]:
+        """Sample a batch from the mixture; see `get_batch` for the return value.
+
+        Raises:
+            ValueError: if a source with nonzero weight has no shard longer than
+                `context_length`.
+        """
+        shard_starts = np.maximum(self.shard_lengths - context_length, 0)
+        row_sources = self.rng.choice(
+            len(self.source_names), size=batch_size, p=self.weights
+        )
+        row_shards = np.empty(batch_size, dtype=np.int64)
+        row_starts = np.empty(batch_size, dtype=np.int64)
+        for source_id in np.unique(row_sources):
+            rows = np.flatnonzero(row_sources == source_id)
+            shards = np.flatnonzero(self.shard_sources == source_id)
+            cumulative = np.cumsum(shard_starts[shards])
+            if cumulative[-1] == 0:
+                raise ValueError(
+                    f"Source {self.source_names[source_id]!r} has no shard longer "
+                    f"than the context length {context_length}"
+                )
+            draws = self.rng.integers(0, cumulative[-1], size=len(rows))
+            positions = np.searchsorted(cumulative, draws, side="right")
+            row_shards[rows] = shards[positions]
+            row_starts[rows] = draws - (
+                cumulative[positions] - shard_starts[shards][positions]
+            )
+            self.tokens_consumed[self.source_names[source_id]] += (
+                len(rows) * context_length
+            )
+
+        batch = torch.empty(batch_size, context_length + 1, dtype=torch.long)
+        for shard_id in np.unique(row_shards):
+            rows = np.flatnonzero(row_shards == shard_id)
+            batch[rows] = _gather_windows(
+                self.shards[shard_id].tokens, row_starts[rows], context_length
+            )
+        batch = batch.to(device)
+        return batch[:, :-1], batch[:, 1:]
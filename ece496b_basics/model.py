@@ -0,0 +1,893 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+
+import math
+from typing import Iterable, Optional
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.autograd.function import once_differentiable
+from torch.utils.checkpoint import checkpoint
+
+
+def gelu(in_features: torch.Tensor) -> torch.Tensor:
+    """Exact GELU, x * Phi(x), with Phi the standard normal CDF."""
+    return 0.5 * in_features * (1 + torch.erf(in_features / math.sqrt(2)))
+
+
+def softmax(in_features: torch.Tensor, dim: int) -> torch.Tensor:
+    """Numerically stable softmax over `dim`: the maximum is subtracted first, so
+    large inputs do not overflow. Low-precision inputs are normalized in float32,
+    and the result has the dtype of the input."""
+    x = in_features.to(torch.promote_types(in_features.dtype, torch.float32))
+    exp = torch.exp(x - x.amax(dim=dim, keepdim=True))
+    return (exp / exp.sum(dim=dim, keepdim=True)).to(in_features.dtype)
+
+
+def causal_mask(
+    seq_len: int, device: Optional[torch.device] = None, offset: int = 0
+) -> torch.Tensor:
+    """(seq_len, offset + seq_len) bool mask that is True where a query would attend
+    to a later key. Query `i` is at position `offset + i`, i.e., the first `offset`
+    keys come from earlier steps (see `KVCache`)."""
+    return torch.triu(
+        torch.ones(seq_len, offset + seq_len, dtype=torch.bool, device=device),
+        diagonal=offset + 1,
+    )
+
+
+def segment_mask(segment_ids: torch.Tensor) -> torch.Tensor:
+    """Block-diagonal causal mask for packed sequences.
+
+    Args:
+        segment_ids: torch.LongTensor
+            Shape (batch_size, seq_len). Tokens with equal ids belong to the same
+            document; see `ece496b_basics.data.get_packed_batch`.
+
+    Returns:
+        Bool tensor of shape (batch_size, 1, seq_len, seq_len), True where a query
+        must not attend to a key: later positions and other documents. The singleton
+        dimension broadcasts over attention heads.
+    """
+    seq_len = segment_ids.shape[-1]
+    other_document = segment_ids[:, :, None] != segment_ids[:, None, :]
+    mask = other_document | causal_mask(seq_len, segment_ids.device)
+    return mask[:, None]
+
+
+def scaled_dot_product_attention(
+    K: torch.Tensor,
+    Q: torch.Tensor,
+    V: torch.Tensor,
+    mask: Optional[torch.Tensor] = None,
+    pdrop: Optional[float] = None,
+    block_size: Optional[int] = None,
+    causal: bool = False,
+) -> torch.Tensor:
+    """softmax(Q K^T / sqrt(d_k)) V.
+
+    With `block_size`, sequences longer than one block go through
+    `tiled_attention`, which never materializes the (seq_len, seq_len) scores.
+
+    Args:
+        K: torch.FloatTensor
+            Keys of shape (batch_size, ..., seq_len, d_k).
+        Q: torch.FloatTensor
+            Queries of shape (batch_size, ..., seq_len, d_k).
+        V: torch.FloatTensor
+            Values of shape (batch_size, ..., seq_len, d_v).
+        mask: Optional[torch.BoolTensor]
+            Broadcastable to (batch_size, ..., seq_len, seq_len). Positions that are
+            True are excluded from the softmax.
+        pdrop: Optional[float]
+            Dropout rate applied to the attention probabilities.
+        block_size: Optional[int]
+            Number of queries and keys per tile. If None, the full score matrix is
+            computed.
+        causal: bool, default is False
+            Also mask out later keys, with the queries aligned to the last keys.
+            Tiled attention skips the tiles above the diagonal altogether.
+
+    Returns:
+        Tensor of shape (batch_size, ..., seq_len, d_v).
+    """
+    q_len, k_len = Q.shape[-2], K.shape[-2]
+    if block_size is not None and max(q_len, k_len) > block_size:
+        return tiled_attention(
+            K, Q, V, mask=mask, pdrop=pdrop, block_size=block_size, causal=causal
+        )
+    if causal:
+        later = causal_mask(q_len, Q.device, offset=k_len - q_len)
+        mask = later if mask is None else mask | later
+    scores = Q @ K.transpose(-2, -1) / math.sqrt(K.shape[-1])
+    if mask is not None:
+        scores = scores.masked_fill(mask, float("-inf"))
+    weights = softmax(scores, dim=-1)
+    if pdrop:
+        weights = F.dropout(weights, p=pdrop)
+    return weights @ V
+
+
+def tiled_attention(
+    K: torch.Tensor,
+    Q: torch.Tensor,
+    V: torch.Tensor,
+    mask: Optional[torch.Tensor] = None,
+    pdrop: Optional[float] = None,
+    block_size: int = 128,
+    causal: bool = False,
+) -> torch.Tensor:
+    """`scaled_dot_product_attention` computed one (block_size, block_size) tile of
+    scores at a time, with an online softmax (Milakov and Gimelshein, 2018).
+
+    For each block of queries, the running row maximum `m`, the running sum of
+    exp(scores - m) and the running unnormalized output are rescaled whenever a key
+    block raises the maximum, and the output is divided by the sum at the end. Dropout
+    is applied to the unnormalized probabilities of each tile, which equals dropping
+    the normalized ones since the normalizer is a per-row constant; the normalizer
+    itself sums the probabilities before dropout. With `causal`, key blocks after
+    the last query of a block are never computed, and only the tiles crossing the
+    diagonal are masked, so about half of the work is skipped.
+
+    The backward pass saves only the inputs, the output and the log-sum-exp of each
+    row, and recomputes every tile of probabilities (and its dropout mask, from a
+    per-call seed) as in FlashAttention (Dao et al., 2022). Peak memory is therefore
+    O(seq_len * block_size) per head instead of O(seq_len^2), with or without
+    autograd, at the cost of computing the scores twice when training.
+
+    Arguments are as in `scaled_dot_product_attention`. Rows whose keys are all
+    masked out are NaN, as with the untiled softmax, and get zero gradients. The
+    running statistics, output and gradients are accumulated in float32 even for
+    low-precision inputs.
+    """
+    if mask is not None:
+        # Singleton query or key dimensions would otherwise be sliced empty.
+        mask = mask.expand(*mask.shape[:-2], Q.shape[-2], K.shape[-2])
+    return _TiledAttention.apply(K, Q, V, mask, pdrop or 0.0, block_size, causal)
+
+
+def _attention_tiles(q_len: int, k_len: int, block_size: int, causal: bool):
+    """Yield (q_start, q_end, key blocks) for every block of queries, where the key
+    blocks are the (k_start, k_end) ranges that are not entirely masked by `causal`."""
+    # Query i is at key position offset + i.
+    offset = k_len - q_len
+    for q_start in range(0, q_len, block_size):
+        q_end = min(q_start + block_size, q_len)
+        k_stop = min(k_len, offset + q_end) if causal else k_len
+        key_blocks = [
+            (k_start, min(k_start + block_size, k_len))
+            for k_start in range(0, k_stop, block_size)
+        ]
+        yield q_start, q_end, key_blocks
+
+
+def _tile_scores(
+    q: torch.Tensor,
+    K: torch.Tensor,
+    mask: Optional[torch.Tensor],
+    causal: bool,
+    offset: int,
+    q_start: int,
+    k_start: int,
+    k_end: int,
+    dtype: torch.dtype,
+) -> torch.Tensor:
+    """Scaled scores of the queries `q`, starting at query q_start, against keys
+    k_start:k_end, in `dtype`, with masked positions set to -inf. Query i is at key
+    position offset + i."""
+    q_end = q_start + q.shape[-2]
+    scores = q @ K[..., k_start:k_end, :].transpose(-2, -1)
+    scores = scores.to(dtype) / math.sqrt(K.shape[-1])
+    if causal and k_end - 1 > offset + q_start:
+        key_positions = torch.arange(k_start, k_end, device=q.device)
+        query_positions = torch.arange(
+            offset + q_start, offset + q_end, device=q.device
+        )
+        scores = scores.masked_fill(
+            key_positions > query_positions[:, None], float("-inf")
+        )
+    if mask is not None:
+        scores = scores.masked_fill(
+            mask[..., q_start:q_end, k_start:k_end], float("-inf")
+        )
+    return scores
+
+
+def _tile_dropout_scale(
+    probs: torch.Tensor, pdrop: float, seed: int, tile: int
+) -> torch.Tensor:
+    """Dropout multipliers (0 or 1 / (1 - pdrop)) for one tile of probabilities,
+    drawn from a generator seeded with seed + tile so that the backward pass can
+    regenerate them."""
+    generator = torch.Generator(device=probs.device)
+    generator.manual_seed(seed + tile)
+    keep = torch.rand(
+        probs.shape, generator=generator, device=probs.device, dtype=probs.dtype
+    )
+    keep = keep >= pdrop
+    return keep * (1 / (1 - pdrop)) if pdrop < 1 else torch.zeros_like(probs)
+
+
+class _TiledAttention(torch.autograd.Function):
+    """Forward and recomputing backward pass of `tiled_attention`."""
+
+    @staticmethod
+    def forward(ctx, K, Q, V, mask, pdrop, block_size, causal):
+        q_len, k_len = Q.shape[-2], K.shape[-2]
+        offset = k_len - q_len
+        seed = int(torch.randint(2**62, ())) if pdrop else 0
+        batch_shape = torch.broadcast_shapes(
+            Q.shape[:-2],
+            K.shape[:-2],
+            V.shape[:-2],
+            mask.shape[:-2] if mask is not None else (),
+        )
+        out = Q.new_empty(*batch_shape, q_len, V.shape[-1])
+        stats_dtype = torch.promote_types(Q.dtype, torch.float32)
+        # Log-sum-exp of the scores of each row, which is all the backward pass needs
+        # to recompute the normalized probabilities of a tile.
+        lse = Q.new_empty(*batch_shape, q_len, 1, dtype=stats_dtype)
+        for q_start, q_end, key_blocks in _attention_tiles(
+            q_len, k_len, block_size, causal
+        ):
+            q = Q[..., q_start:q_end, :]
+            row_max = q.new_full((*q.shape[:-1], 1), float("-inf"), dtype=stats_dtype)
+            row_sum = q.new_zeros((*q.shape[:-1], 1), dtype=stats_dtype)
+            acc = q.new_zeros(
+                (*batch_shape, q_end - q_start, V.shape[-1]), dtype=stats_dtype
+            )
+            for k_start, k_end in key_blocks:
+                scores = _tile_scores(
+                    q, K, mask, causal, offset, q_start, k_start, k_end, stats_dtype
+                )
+                new_max = torch.maximum(row_max, scores.amax(dim=-1, keepdim=True))
+                # Keep exp() finite for rows that have only seen masked keys so far.
+                shift = new_max.masked_fill(new_max == float("-inf"), 0.0)
+                correction = torch.exp(row_max - shift)
+                probs = torch.exp(scores - shift)
+                row_sum = row_sum * correction + probs.sum(dim=-1, keepdim=True)
+                if pdrop:
+                    probs = probs * _tile_dropout_scale(
+                        probs, pdrop, seed, q_start * k_len + k_start
+                    )
+                acc = acc * correction + probs.to(V.dtype) @ V[..., k_start:k_end, :]
+                row_max = new_max
+            out[..., q_start:q_end, :] = acc / row_sum
+            lse[..., q_start:q_end, :] = row_max + torch.log(row_sum)
+        ctx.save_for_backward(K, Q, V, mask, out, lse)
+        ctx.pdrop, ctx.seed = pdrop, seed
+        ctx.block_size, ctx.causal = block_size, causal
+        return out
+
+    @staticmethod
+    @once_differentiable
+    def backward(ctx, grad_out):
+        K, Q, V, mask, out, lse = ctx.saved_tensors
+        pdrop, seed = ctx.pdrop, ctx.seed
+        q_len, k_len = Q.shape[-2], K.shape[-2]
+        offset = k_len - q_len
+        stats_dtype = lse.dtype
+        batch_shape = lse.shape[:-2]
+        Kf, Qf, Vf = (x.to(stats_dtype) for x in (K, Q, V))
+        grad_out = grad_out.to(stats_dtype)
+        # Rows whose keys are all masked out have an lse of -inf; an lse of +inf makes
+        # their probabilities 0 instead of NaN, so they do not poison the key and
+        # value gradients.
+        dead = lse == float("-inf")
+        lse = lse.masked_fill(dead, float("inf"))
+        # With probabilities P and their gradients dP, the gradient of the scores is
+        # P * (dP - rowsum(P * dP)), and rowsum(P * dP) = rowsum(out * grad_out).
+        delta = (grad_out * out.to(stats_dtype)).sum(dim=-1, keepdim=True)
+        delta = delta.masked_fill(dead, 0.0)
+        grad_Q = Qf.new_zeros(*batch_shape, q_len, Q.shape[-1])
+        grad_K = Kf.new_zeros(*batch_shape, k_len, K.shape[-1])
+        grad_V = Vf.new_zeros(*batch_shape, k_len, V.shape[-1])
+        scale = 1 / math.sqrt(K.shape[-1])
+        for q_start, q_end, key_blocks in _attention_tiles(
+            q_len, k_len, ctx.block_size, ctx.causal
+        ):
+            q = Q[..., q_start:q_end, :]
+            grad_out_block = grad_out[..., q_start:q_end, :]
+            for k_start, k_end in key_blocks:
+                scores = _tile_scores(
+                    q, K, mask, ctx.causal, offset, q_start, k_start, k_end, stats_dtype
+                )
+                probs = torch.exp(scores - lse[..., q_start:q_end, :])
+                v = Vf[..., k_start:k_end, :]
+                grad_probs = grad_out_block @ v.transpose(-2, -1)
+                if pdrop:
+                    dropout_scale = _tile_dropout_scale(
+                        probs, pdrop, seed, q_start * k_len + k_start
+                    )
+                    dropped = probs * dropout_scale
+                    grad_probs = grad_probs * dropout_scale
+                else:
+                    dropped = probs
+                grad_V[..., k_start:k_end, :] += (
+                    dropped.transpose(-2, -1) @ grad_out_block
+                )
+                grad_scores = (
+                    probs * (grad_probs - delta[..., q_start:q_end, :]) * scale
+                )
+                grad_Q[..., q_start:q_end, :] += grad_scores @ Kf[..., k_start:k_end, :]
+                grad_K[..., k_start:k_end, :] += (
+                    grad_scores.transpose(-2, -1) @ Qf[..., q_start:q_end, :]
+                )
+        return (
+            grad_K.sum_to_size(K.shape).to(K.dtype),
+            grad_Q.sum_to_size(Q.shape).to(Q.dtype),
+            grad_V.sum_to_size(V.shape).to(V.dtype),
+            None,
+            None,
+            None,
+            None,
+        )
+
+
+class KVCache:
+    """Keys and values of one attention layer for incremental decoding, preallocated
+    to the model's context length so that appending a step never reallocates.
+
+    For batches of prompts of different lengths, the prompts are left-padded and
+    `padding` holds the number of padding positions of each row; attention never
+    looks at them, and `TransformerLM` shifts each row's positions accordingly.
+
+    Args:
+        batch_size: int
+            Number of sequences decoded together.
+        num_heads: int
+            Number of attention heads.
+        max_len: int
+            Capacity in tokens, usually the context length.
+        d_head: int
+            Dimensionality of each head.
+        device: Optional[torch.device]
+            Device of the cache tensors.
+        dtype: Optional[torch.dtype]
+            Dtype of the cache tensors.
+        padding: Optional[torch.LongTensor]
+            Number of left-padding positions of each row, shape (batch_size,).
+    """
+
+    def __init__(
+        self,
+        batch_size: int,
+        num_heads: int,
+        max_len: int,
+        d_head: int,
+        device: Optional[torch.device] = None,
+        dtype: Optional[torch.dtype] = None,
+        padding: Optional[torch.Tensor] = None,
+    ):
+        shape = (batch_size, num_heads, max_len, d_head)
+        self.keys = torch.empty(shape, device=device, dtype=dtype)
+        self.values = torch.empty(shape, device=device, dtype=dtype)
+        self.length = 0
+        self.padding = padding
+        self.min_padding = int(padding.min()) if padding is not None else 0
+
+    def select(self, rows: torch.Tensor) -> None:
+        """Keep only the given rows, e.g. to drop finished sequences from a batch."""
+        self.keys = self.keys[rows]
+        self.values = self.values[rows]
+        if self.padding is not None:
+            self.padding = self.padding[rows]
+            self.min_padding = int(self.padding.min()) if len(rows) else 0
+
+    def mask(self, seq_len: int, device: torch.device) -> Optional[torch.Tensor]:
+        """Attention mask for `seq_len` new queries following the cached positions,
+        before they are appended; None if nothing needs masking."""
+        offset = self.length
+        mask = causal_mask(seq_len, device, offset) if seq_len > 1 else None
+        if self.padding is None:
+            return mask
+        keys = torch.arange(offset + seq_len, device=device)
+        queries = torch.arange(offset, offset + seq_len, device=device)
+        padding = self.padding[:, None, None, None]
+        # Real queries skip the padding keys. Padding queries keep attending to
+        # (padding) keys, so that no softmax row is empty.
+        padding_mask = (keys < padding) & (queries[:, None] >= padding)
+        return padding_mask if mask is None else padding_mask | mask
+
+    @property
+    def max_len(self) -> int:
+        return self.keys.shape[-2]
+
+    def append(
+        self, k: torch.Tensor, v: torch.Tensor
+    ) -> tuple[torch.Tensor, torch.Tensor]:
+        """Store the keys and values of the next `k.shape[-2]` positions and return
+        views of all cached keys and values."""
+        end = self.length + k.shape[-2]
+        if end > self.max_len:
+            raise ValueError(f"KV cache of {self.max_len} positions is full")
+        self.keys[..., self.length : end, :] = k
+        self.values[..., self.length : end, :] = v
+        self.length = end
+        return self.keys[..., :end, :], self.values[..., :end, :]
+
+
+class MultiHeadSelfAttention(nn.Module):
+    """Causal multi-head self-attention with the query, key and value projections of
+    all heads fused into one matrix multiply.
+
+    The fused weight is `qkv_proj.weight`, the concatenation of the query, key and
+    value weights along the output dimension. State dicts with separate
+    `q_proj.weight`, `k_proj.weight` and `v_proj.weight` load as well.
+
+    The causal mask is cached in a non-persistent buffer that grows to the longest
+    sequence seen (the context length, in training) and is sliced for shorter ones.
+    Tiled attention needs no mask: it skips the tiles above the diagonal.
+
+    Args:
+        d_model: int
+            Dimensionality of the input and output.
+        num_heads: int
+            Number of attention heads. Must divide `d_model`.
+        attn_pdrop: float, default is 0.0
+            Dropout rate of the attention probabilities during training.
+        attn_block_size: Optional[int], default is None
+            If given, attention over longer sequences is computed in tiles of this
+            many queries and keys (see `tiled_attention`).
+    """
+
+    def __init__(
+        self,
+        d_model: int,
+        num_heads: int,
+        attn_pdrop: float = 0.0,
+        attn_block_size: Optional[int] = None,
+    ):
+        super().__init__()
+        if d_model % num_heads != 0:
+            raise ValueError(f"num_heads={num_heads} does not divide d_model={d_model}")
+        self.d_model = d_model
+        self.num_heads = num_heads
+        self.d_head = d_model // num_heads
+        self.attn_pdrop = attn_pdrop
+        self.attn_block_size = attn_block_size
+        self.qkv_proj = nn.Linear(d_model, 3 * d_model, bias=False)
+        self.output_proj = nn.Linear(d_model, d_model, bias=False)
+        self.register_load_state_dict_pre_hook(_fuse_qkv_weights)
+        self.register_buffer(
+            "causal_mask_cache", torch.ones(0, 0, dtype=torch.bool), persistent=False
+        )
+
+    def _causal_mask(self, seq_len: int, device: torch.device) -> torch.Tensor:
+        if len(self.causal_mask_cache) < seq_len:
+            self.causal_mask_cache = causal_mask(seq_len, device)
+        return self.causal_mask_cache[:seq_len, :seq_len]
+
+    def forward(
+        self,
+        x: torch.Tensor,
+        segment_ids: Optional[torch.Tensor] = None,
+        kv_cache: Optional[KVCache] = None,
+    ) -> torch.Tensor:
+        """
+        Args:
+            x: torch.FloatTensor
+                Input of shape (batch_size, seq_len, d_model).
+            segment_ids: Optional[torch.LongTensor]
+                Document ids of shape (batch_size, seq_len) for packed sequences.
+                If given, attention is block-diagonal causal (see `segment_mask`).
+            kv_cache: Optional[KVCache]
+                Keys and values of the preceding positions. `x` holds the positions
+                that follow them; their keys and values are appended to the cache.
+
+        Returns:
+            Tensor of shape (batch_size, seq_len, d_model).
+        """
+        seq_len = x.shape[-2]
+        # (..., seq_len, 3 * d_model) -> 3 x (..., num_heads, seq_len, d_head), as
+        # views of the projection output.
+        qkv = self.qkv_proj(x).unflatten(-1, (3, self.num_heads, self.d_head))
+        q, k, v = qkv.movedim(-3, 0).transpose(-3, -2).unbind(0)
+        tiled = self.attn_block_size is not None and seq_len > self.attn_block_size
+        causal = False
+        if kv_cache is not None:
+            if segment_ids is not None:
+                raise ValueError("segment_ids are not supported with a KV cache")
+            mask = kv_cache.mask(seq_len, x.device)
+            k, v = kv_cache.append(k, v)
+        elif segment_ids is not None:
+            mask = segment_mask(segment_ids)
+            # The segment mask is causal already; this only skips tiles.
+            causal = tiled
+        elif tiled:
+            mask, causal = None, True
+        else:
+            mask = self._causal_mask(seq_len, x.device)
+        pdrop = self.attn_pdrop if self.training else None
+        out = scaled_dot_product_attention(
+            k,
+            q,
+            v,
+            mask=mask,
+            pdrop=pdrop,
+            block_size=self.attn_block_size,
+            causal=causal,
+        )
+        return self.output_proj(out.transpose(-3, -2).flatten(-2))
+
+
+def _fuse_qkv_weights(module, state_dict, prefix, *args):
+    """Load-state-dict pre-hook of `MultiHeadSelfAttention` that replaces separate
+    query, key and value weights by their concatenation."""
+    names = [f"{prefix}{name}_proj.weight" for name in "qkv"]
+    if all(name in state_dict for name in names):
+        state_dict[f"{prefix}qkv_proj.weight"] = torch.cat(
+            [state_dict.pop(name) for name in names]
+        )
+
+
+class RMSNorm(nn.Module):
+    """Root mean square layer normalization (Zhang and Sennrich, 2019), computed in
+    float32 for low-precision inputs.
+
+    Args:
+        d_model: int
+            Dimensionality of the input.
+        eps: float, default is 1e-5
+            Added to the mean square for numerical stability.
+    """
+
+    def __init__(self, d_model: int, eps: float = 1e-5):
+        super().__init__()
+        self.eps = eps
+        self.weight = nn.Parameter(torch.ones(d_model))
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        x32 = x.to(torch.promote_types(x.dtype, torch.float32))
+        rms = torch.sqrt(x32.pow(2).mean(dim=-1, keepdim=True) + self.eps)
+        return (x32 / rms * self.weight).to(x.dtype)
+
+
+class PositionwiseFeedForward(nn.Module):
+    """w2(gelu(w1(x))), without biases."""
+
+    def __init__(self, d_model: int, d_ff: int):
+        super().__init__()
+        self.w1 = nn.Linear(d_model, d_ff, bias=False)
+        self.w2 = nn.Linear(d_ff, d_model, bias=False)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return self.w2(gelu(self.w1(x)))
+
+
+class TransformerBlock(nn.Module):
+    """Pre-norm Transformer block: x + attn(ln1(x)), then + ffn(ln2(x)), with
+    dropout on each sub-layer output.
+
+    Args:
+        d_model: int
+            Dimensionality of the input and output.
+        num_heads: int
+            Number of attention heads.
+        d_ff: int
+            Dimensionality of the feed-forward inner layer.
+        attn_pdrop: float, default is 0.0
+            Dropout rate of the attention probabilities.
+        residual_pdrop: float, default is 0.0
+            Dropout rate of the sub-layer outputs.
+        attn_block_size: Optional[int], default is None
+            Tile size of the attention (see `MultiHeadSelfAttention`).
+    """
+
+    def __init__(
+        self,
+        d_model: int,
+        num_heads: int,
+        d_ff: int,
+        attn_pdrop: float = 0.0,
+        residual_pdrop: float = 0.0,
+        attn_block_size: Optional[int] = None,
+    ):
+        super().__init__()
+        self.ln1 = RMSNorm(d_model)
+        self.attn = MultiHeadSelfAttention(
+            d_model, num_heads, attn_pdrop, attn_block_size
+        )
+        self.ln2 = RMSNorm(d_model)
+        self.ffn = PositionwiseFeedForward(d_model, d_ff)
+        self.dropout = nn.Dropout(residual_pdrop)
+
+    def forward(
+        self,
+        x: torch.Tensor,
+        segment_ids: Optional[torch.Tensor] = None,
+        kv_cache: Optional[KVCache] = None,
+    ) -> torch.Tensor:
+        x = x + self.dropout(self.attn(self.ln1(x), segment_ids, kv_cache))
+        return x + self.dropout(self.ffn(self.ln2(x)))
+
+
+def sample_next_token(
+    logits: torch.Tensor,
+    temperature: float = 1.0,
+    top_p: float = 1.0,
+    generator: Optional[torch.Generator] = None,
+) -> torch.Tensor:
+    """Sample one token id per row of `logits` (shape (..., vocab_size)).
+
+    A temperature of 0 picks the most likely token. Otherwise the logits are divided
+    by `temperature`, and with `top_p < 1` sampling is restricted to the smallest
+    set of most likely tokens whose probability mass reaches `top_p` (nucleus
+    sampling).
+    """
+    if temperature == 0:
+        return logits.argmax(dim=-1)
+    probs = softmax(logits.float() / temperature, dim=-1)
+    if top_p < 1.0:
+        sorted_probs, order = probs.sort(dim=-1, descending=True)
+        # Drop a token if the tokens more likely than it already reach top_p.
+        outside = sorted_probs.cumsum(dim=-1) - sorted_probs >= top_p
+        sorted_probs = sorted_probs.masked_fill(outside, 0.0)
+        probs = torch.zeros_like(probs).scatter(-1, order, sorted_probs)
+    flat = probs.reshape(-1, probs.shape[-1])
+    sampled = torch.multinomial(flat, 1, generator=generator)
+    return sampled.reshape(probs.shape[:-1])
+
+
+class TransformerLM(nn.Module):
+    """Decoder-only Transformer language model with learned absolute position
+    embeddings.
+
+    For generation, `init_kv_caches` preallocates per-layer key/value caches and
+    `forward` then only needs the new tokens of each step (see `generate`).
+
+    Layers whose indices are in `checkpoint_layers` are run with activation
+    checkpointing when gradients are enabled: only their input is kept for the
+    backward pass, and their forward pass is recomputed during it, with the same
+    random state, so the gradients are unchanged. The set can be changed between
+    steps.
+
+    With `autocast_dtype` (e.g., torch.bfloat16), the forward pass runs under
+    `torch.autocast`: the parameters stay float32 master weights and receive
+    float32 gradients, while matrix multiplies and attention run in the low-precision
+    dtype. The residual stream stays float32, RMSNorm and softmax normalize in
+    float32, and the logits are returned in `autocast_dtype`, for `cross_entropy`
+    (see `ece496b_basics.nn_utils`) to reduce in float32.
+
+    Args:
+        vocab_size: int
+            Size of the vocabulary.
+        context_length: int
+            Maximum number of tokens processed at once.
+        d_model: int
+            Dimensionality of the embeddings and sub-layer outputs.
+        num_layers: int
+            Number of Transformer blocks.
+        num_heads: int
+            Number of attention heads.
+        d_ff: int
+            Dimensionality of the feed-forward inner layer.
+        attn_pdrop: float, default is 0.0
+            Dropout rate of the attention probabilities.
+        residual_pdrop: float, default is 0.0
+            Dropout rate of the embeddings and of the sub-layer outputs.
+        attn_block_size: Optional[int], default is None
+            Tile size of the attention (see `MultiHeadSelfAttention`).
+        checkpoint_layers: Iterable[int], default is ()
+            Indices of the layers to run with activation checkpointing.
+        autocast_dtype: Optional[torch.dtype], default is None
+            If given, the dtype of mixed-precision autocast in `forward`.
+    """
+
+    def __init__(
+        self,
+        vocab_size: int,
+        context_length: int,
+        d_model: int,
+        num_layers: int,
+        num_heads: int,
+        d_ff: int,
+        attn_pdrop: float = 0.0,
+        residual_pdrop: float = 0.0,
+        attn_block_size: Optional[int] = None,
+        checkpoint_layers: Iterable[int] = (),
+        autocast_dtype: Optional[torch.dtype] = None,
+    ):
+        super().__init__()
+        self.context_length = context_length
+        self.autocast_dtype = autocast_dtype
+        self.token_embeddings = nn.Embedding(vocab_size, d_model)
+        self.position_embeddings = nn.Embedding(context_length, d_model)
+        self.layers = nn.ModuleList(
+            TransformerBlock(
+                d_model, num_heads, d_ff, attn_pdrop, residual_pdrop, attn_block_size
+            )
+            for _ in range(num_layers)
+        )
+        self.ln_final = RMSNorm(d_model)
+        self.lm_head = nn.Linear(d_model, vocab_size, bias=False)
+        self.dropout = nn.Dropout(residual_pdrop)
+        self.checkpoint_layers = set(checkpoint_layers)
+        if not self.checkpoint_layers <= set(range(num_layers)):
+            raise ValueError(
+                f"checkpoint_layers {sorted(self.checkpoint_layers)} must be layer "
+                f"indices in [0, {num_layers})"
+            )
+
+    def init_kv_caches(
+        self,
+        batch_size: int,
+        max_len: Optional[int] = None,
+        padding: Optional[torch.Tensor] = None,
+    ) -> list[KVCache]:
+        """Empty KV caches for `forward`, one per layer, holding `max_len` positions
+        (default `context_length`). See `KVCache` for `padding`."""
+        weight = self.token_embeddings.weight
+        return [
+            KVCache(
+                batch_size,
+                layer.attn.num_heads,
+                max_len if max_len is not None else self.context_length,
+                layer.attn.d_head,
+                device=weight.device,
+                dtype=self.autocast_dtype or weight.dtype,
+                padding=padding,
+            )
+            for layer in self.layers
+        ]
+
+    def forward(
+        self,
+        in_indices: torch.Tensor,
+        segment_ids: Optional[torch.Tensor] = None,
+        kv_caches: Optional[list[KVCache]] = None,
+    ) -> torch.Tensor:
+        """
+        Args:
+            in_indices: torch.LongTensor
+                Token ids of shape (batch_size, seq_len).
+            segment_ids: Optional[torch.LongTensor]
+                Document ids of shape (batch_size, seq_len) for packed sequences.
+            kv_caches: Optional[list[KVCache]]
+                Caches from `init_kv_caches`. `in_indices` then holds the tokens
+                following the cached ones, and the caches are extended with them.
+
+        Returns:
+            Logits of shape (batch_size, seq_len, vocab_size), in `autocast_dtype` if
+            it is set.
+        """
+        with torch.autocast(
+            in_indices.device.type,
+            dtype=self.autocast_dtype,
+            enabled=self.autocast_dtype is not None,
+        ):
+            return self._forward(in_indices, segment_ids, kv_caches)
+
+    def _forward(
+        self,
+        in_indices: torch.Tensor,
+        segment_ids: Optional[torch.Tensor],
+        kv_caches: Optional[list[KVCache]],
+    ) -> torch.Tensor:
+        seq_len = in_indices.shape[-1]
+        start, min_padding = 0, 0
+        if kv_caches is not None:
+            start, min_padding = kv_caches[0].length, kv_caches[0].min_padding
+        if start + seq_len - min_padding > self.context_length:
+            raise ValueError(
+                f"{start + seq_len - min_padding} positions exceed the context length "
+                f"{self.context_length}"
+            )
+        positions = torch.arange(start, start + seq_len, device=in_indices.device)
+        if kv_caches is not None and kv_caches[0].padding is not None:
+            # Per-row positions of left-padded rows; padding sits at position 0.
+            positions = (positions - kv_caches[0].padding[:, None]).clamp(min=0)
+        x = self.token_embeddings(in_indices) + self.position_embeddings(positions)
+        x = self.dropout(x)
+        for i, layer in enumerate(self.layers):
+            if kv_caches is not None:
+                x = layer(x, segment_ids, kv_caches[i])
+            elif i in self.checkpoint_layers and torch.is_grad_enabled():
+                x = checkpoint(layer, x, segment_ids, use_reentrant=False)
+            else:
+                x = layer(x, segment_ids)
+        return self.lm_head(self.ln_final(x))
+
+    @torch.no_grad()
+    def generate(
+        self,
+        prompt_ids: torch.Tensor | list[int],
+        max_new_tokens: int,
+        temperature: float = 1.0,
+        top_p: float = 1.0,
+        eos_id: Optional[int] = None,
+        generator: Optional[torch.Generator] = None,
+    ) -> torch.Tensor:
+        """Sample a continuation of `prompt_ids` with KV caching.
+
+        The prompt is processed in one forward pass; after that every step feeds
+        only the newly sampled token, so each step costs time linear in the length
+        so far instead of recomputing attention over the whole prefix. Generation
+        stops early once the context is full.
+
+        Args:
+            prompt_ids: torch.LongTensor | list[int]
+                1D prompt of at most `context_length` token ids.
+            max_new_tokens: int
+                Maximum number of tokens to generate.
+            temperature: float, default is 1.0
+                Softmax temperature; 0 means greedy decoding.
+            top_p: float, default is 1.0
+                Nucleus sampling threshold (see `sample_next_token`).
+            eos_id: Optional[int]
+                Stop after generating this token, e.g. `<|endoftext|>`.
+            generator: Optional[torch.Generator]
+                Random number generator for sampling.
+
+        Returns:
+            1D LongTensor with the generated token ids, without the prompt.
+        """
+        return self.generate_batch(
+            [prompt_ids], max_new_tokens, temperature, top_p, eos_id, generator
+        )[0]
+
+    @torch.no_grad()
+    def generate_batch(
+        self,
+        prompts: list[torch.Tensor | list[int]],
+        max_new_tokens: int,
+        temperature: float = 1.0,
+        top_p: float = 1.0,
+        eos_id: Optional[int] = None,
+        generator: Optional[torch.Generator] = None,
+    ) -> list[torch.Tensor]:
+        """Sample continuations of several prompts at once; see `generate`.
+
+        Prompts are left-padded to a common length and every row gets its own
+        positions, so the result for a prompt does not depend on the others in
+        the batch (up to floating point). A row finishes after `eos_id`, after
+        `max_new_tokens` tokens or when its context is full; finished rows are
+        dropped from the batch and the KV caches, so later steps only pay for the
+        rows still running.
+
+        Returns:
+            For each prompt, a 1D LongTensor with the generated token ids.
+        """
+        device = self.token_embeddings.weight.device
+        prompts = [
+            torch.as_tensor(prompt, dtype=torch.long, device=device)
+            for prompt in prompts
+        ]
+        lengths = torch.tensor([len(prompt) for prompt in prompts], device=device)
+        if (lengths == 0).any():
+            raise ValueError("Prompts must not be empty")
+        batch_size, padded_length = len(prompts), int(lengths.max())
+        in_indices = torch.zeros(
+            batch_size, padded_length, dtype=torch.long, device=device
+        )
+        for row, prompt in enumerate(prompts):
+            in_indices[row, padded_length - len(prompt) :] = prompt
+        padding = padded_length - lengths
+        kv_caches = self.init_kv_caches(
+            batch_size,
+            max_len=padded_length + max_new_tokens,
+            padding=padding if padding.any() else None,
+        )
+
+        generated: list[list[int]] = [[] for _ in prompts]
+        rows = torch.arange(batch_size, device=device)
+        if max_new_tokens > 0:
+            logits = self(in_indices, kv_caches=kv_caches)[:, -1]
+        for step in range(1, max_new_tokens + 1):
+            next_ids = sample_next_token(logits, temperature, top_p, generator)
+            for row, next_id in zip(rows.tolist(), next_ids.tolist()):
+                generated[row].append(next_id)
+            # The next step would feed the new token at position `length + step - 1`.
+            finished = lengths[rows] + step > self.context_length
+            if eos_id is not None:
+                finished |= next_ids == eos_id
+            if step == max_new_tokens or finished.all():
+                break
+            if finished.any():
+                keep = (~finished).nonzero().squeeze(-1)
+                rows, next_ids = rows[keep], next_ids[keep]
+                for kv_cache in kv_caches:
+                    kv_cache.select(keep)
+            logits = self(next_ids[:, None], kv_caches=kv_caches)[:, -1]
+        return [torch.tensor(ids, dtype=torch.long, device=device) for ids in generated]
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+
+from typing import Iterable
+
+import torch
+
+
+def cross_entropy(inputs: torch.Tensor, targets: torch.Tensor) -> torch.Tensor:
+    """Mean cross-entropy of `targets` under the logits `inputs`, computed as
+    logsumexp(inputs) - inputs[target] so that no probability underflows.
+
+    The reduction is always done in (at least) float32, so that low-precision logits,
+    e.g., from a bfloat16 autocast forward pass, do not lose precision in the sum.
+
+    Args:
+        inputs: torch.FloatTensor
+            Logits of shape (..., num_classes).
+        targets: torch.LongTensor
+            Class indices of shape (...).
+
+    Returns:
+        Float32 (or float64) tensor of shape ().
+    """
+    logits = inputs.to(torch.promote_types(inputs.dtype, torch.float32))
+    target_logits = logits.gather(-1, targets[..., None]).squeeze(-1)
+    return (logits.logsumexp(dim=-1) - target_logits).mean()
+
+
+@torch.no_grad()
+def clip_gradients(
+    parameters: Iterable[torch.nn.Parameter], max_l2_norm: float, eps: float = 1e-6
+) -> torch.Tensor:
+    """Scale the gradients of `parameters` in place so that their combined l2 norm is
+    at most `max_l2_norm`. Parameters without gradients are skipped.
+
+    Returns:
+        The combined l2 norm of the gradients before clipping.
+    """
+    grads = [param.grad for param in parameters if param.grad is not None]
+    if not grads:
+        return torch.tensor(0.0)
+    total_norm = torch.linalg.vector_norm(
+        torch.stack(
+            [torch.linalg.vector_norm(grad, dtype=torch.float32) for grad in grads]
+        )
+    )
+    if total_norm > max_l2_norm:
+        scale = max_l2_norm / (total_norm + eps)
+        for grad in grads:
+            grad.mul_(scale)
+    return total_norm
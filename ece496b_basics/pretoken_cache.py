@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+import struct
+from collections import Counter
+from typing import Optional
+
+import numpy as np
+
+from .pretokenization import PAT
+
+logger = logging.getLogger(__name__)
+
+_MAGIC = b"PTC1"
+# Magic, number of entries, total blob size.
+_HEADER = struct.Struct("<4sQQ")
+_SUFFIX = ".ptc"
+
+
+def pretoken_cache_key(
+    input_path: str | os.PathLike,
+    special_tokens: Optional[list[str]],
+    pattern: str = PAT,
+) -> str:
+    """Hex digest identifying a pre-tokenization result: the SHA-256 of the corpus
+    contents, the pre-tokenization regex and the special tokens."""
+    digest = hashlib.sha256()
+    digest.update(json.dumps([pattern, list(special_tokens or [])]).encode("utf-8"))
+    with open(input_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class PretokenCache:
+    """On-disk cache of pre-token frequency tables with size-bounded LRU eviction.
+
+    Each entry is one file holding a small header, the counts as a uint64 array, the
+    UTF-8 byte lengths of the pre-tokens as a uint32 array, and the concatenated
+    UTF-8 bytes of all pre-tokens. Reading an entry touches its modification time,
+    which is what eviction uses to find the least recently used entries.
+
+    Args:
+        cache_dir: str | os.PathLike
+            Directory holding the cache entries. Created if it does not exist.
+        max_bytes: int, default is 4 GiB
+            Upper bound on the total size of all entries in `cache_dir`.
+    """
+
+    def __init__(self, cache_dir: str | os.PathLike, max_bytes: int = 4 * 2**30):
+        self.cache_dir = os.fspath(cache_dir)
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key + _SUFFIX)
+
+    def get(self, key: str) -> Optional[Counter[str]]:
+        """Return the cached counts for `key`, or None on a miss."""
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        magic, num_entries, blob_size = _HEADER.unpack_from(data)
+        if magic != _MAGIC:
+            logger.warning("Ignoring malformed pre-token cache entry %s", path)
+            return None
+        offset = _HEADER.size
+        counts = np.frombuffer(data, dtype="<u8", count=num_entries, offset=offset)
+        offset += counts.nbytes
+        lengths = np.frombuffer(data, dtype="<u4", count=num_entries, offset=offset)
+        offset += lengths.nbytes
+        blob = data[offset : offset + blob_size]
+
+        result: Counter[str] = Counter()
+        start = 0
+        for length, count in zip(lengths.tolist(), counts.tolist()):
+            result[blob[start : start + length].decode("utf-8")] = count
+            start += length
+        os.utime(path)
+        return result
+
+    def put(self, key: str, counts: Counter[str]) -> None:
+        """Store `counts` under `key`, then evict entries until under `max_bytes`."""
+        encoded = [pretoken.encode("utf-8") for pretoken in counts]
+        num_entries = len(encoded)
+        count_array = np.fromiter(counts.values(), dtype="<u8", count=num_entries)
+        length_array = np.fromiter(map(len, encoded), dtype="<u4", count=num_entries)
+        blob = b"".join(encoded)
+        path = self._path(key)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(_HEADER.pack(_MAGIC, num_entries, len(blob)))
+            f.write(count_array.tobytes())
+            f.write(length_array.tobytes())
+            f.write(blob)
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self) -> None:
+        """Delete least recently used entries until the cache fits in `max_bytes`."""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(_SUFFIX):
+                stat = os.stat(os.path.join(self.cache_dir, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.cache_dir, name))
+            total -= size
+            logger.info("Evicted pre-token cache entry %s", name)
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+
+import math
+import os
+from collections import Counter
+from multiprocessing import Pool
+from typing import BinaryIO, Optional
+
+import regex as re
+
+# GPT-2 pre-tokenization pattern (github.com/openai/tiktoken/pull/234).
+PAT = r"""'(?:[sdmt]|ll|ve|re)| ?\p{L}+| ?\p{N}+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+"""
+
+# Upper bound on the size of a single chunk handed to a worker, so that peak
+# memory stays bounded on corpora much larger than `num_workers` chunks.
+_MAX_CHUNK_BYTES = 64 * 1024 * 1024
+
+_PAT_RE = re.compile(PAT)
+
+
+def special_tokens_pattern(special_tokens: Optional[list[str]]) -> Optional[re.Pattern]:
+    """Compile an alternation matching any of the special tokens, longest first,
+    so that overlapping special tokens prefer the longest match.
+    Returns None if there are no special tokens."""
+    if not special_tokens:
+        return None
+    ordered = sorted(special_tokens, key=len, reverse=True)
+    return re.compile("|".join(re.escape(token) for token in ordered))
+
+
+def count_pretokens_in_text(
+    text: str, special_tokens: Optional[list[str]]
+) -> Counter[str]:
+    """Pre-tokenize `text` and count the resulting pre-tokens.
+
+    Special tokens act as hard boundaries: the text is split on them first, and the
+    special tokens themselves are dropped, so no pre-token (and thus no merge) ever
+    spans a special token.
+    """
+    counts: Counter[str] = Counter()
+    special_re = special_tokens_pattern(special_tokens)
+    segments = special_re.split(text) if special_re is not None else [text]
+    for segment in segments:
+        counts.update(_PAT_RE.findall(segment))
+    return counts
+
+
+def _spans_special_token(
+    window: bytes, offset: int, special_tokens: list[bytes]
+) -> bool:
+    """Whether some occurrence of a special token in `window` straddles `offset`."""
+    for token in special_tokens:
+        for k in range(1, len(token)):
+            start = offset - k
+            if start >= 0 and window[start : start + len(token)] == token:
+                return True
+    return False
+
+
+def find_chunk_boundaries(
+    file: BinaryIO,
+    desired_num_chunks: int,
+    special_tokens: list[bytes],
+) -> list[int]:
+    """Split a file into byte ranges that can be pre-tokenized independently.
+
+    Every interior boundary is placed at the start of a special token occurrence
+    that no other (longer) special token straddles, so splitting there yields exactly
+    the same segments as splitting the whole text on special tokens. Boundaries are
+    searched forward from evenly spaced guesses; fewer chunks than requested may be
+    returned if the file has too few special tokens.
+
+    Returns:
+        Sorted list of byte offsets, starting with 0 and ending with the file size.
+    """
+    file.seek(0, os.SEEK_END)
+    file_size = file.tell()
+    if not special_tokens or desired_num_chunks <= 1 or file_size == 0:
+        return [0, file_size]
+
+    max_token_len = max(len(token) for token in special_tokens)
+    chunk_size = file_size // desired_num_chunks
+    mini_chunk_size = 4096
+    boundaries = [0]
+    for i in range(1, desired_num_chunks):
+        position = max(i * chunk_size, boundaries[-1] + 1)
+        boundary = file_size
+        while position < file_size:
+            file.seek(position)
+            mini_chunk = file.read(mini_chunk_size + max_token_len)
+            candidates = [
+                found
+                for found in (mini_chunk.find(token) for token in special_tokens)
+                if 0 <= found < mini_chunk_size
+            ]
+            if not candidates:
+                position += mini_chunk_size
+                continue
+            candidate = position + min(candidates)
+            window_start = max(0, candidate - max_token_len)
+            file.seek(window_start)
+            window = file.read(2 * max_token_len)
+            if _spans_special_token(window, candidate - window_start, special_tokens):
+                position = candidate + 1
+                continue
+            boundary = candidate
+            break
+        if boundary >= file_size:
+            break
+        boundaries.append(boundary)
+    boundaries.append(file_size)
+    return boundaries
+
+
+def _count_chunk(
+    args: tuple[str | os.PathLike, int, int, Optional[list[str]]],
+) -> Counter[str]:
+    input_path, start, end, special_tokens = args
+    with open(input_path, "rb") as f:
+        f.seek(start)
+        text = f.read(end - start).decode("utf-8", errors="ignore")
+    return count_pretokens_in_text(text, special_tokens)
+
+
+def count_pretokens(
+    input_path: str | os.PathLike,
+    special_tokens: Optional[list[str]] = None,
+    num_workers: Optional[int] = None,
+) -> Counter[str]:
+    """Count pre-tokens in a file, optionally in parallel.
+
+    The file is split at special-token boundaries (see `find_chunk_boundaries`),
+    each chunk is counted in a worker process, and the per-chunk counters are summed.
+    The result is identical to counting the whole file in a single process.
+
+    Args:
+        input_path: str | os.PathLike
+            Path to the UTF-8 text corpus.
+        special_tokens: Optional[list[str]]
+            Special tokens to split on before pre-tokenizing. They are not counted.
+        num_workers: Optional[int]
+            Number of worker processes. Defaults to `os.cpu_count()`.
+            With a single worker (or a single chunk) no process pool is created.
+
+    Returns:
+        Counter mapping pre-token strings to their number of occurrences.
+    """
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    encoded_special_tokens = [token.encode("utf-8") for token in special_tokens or []]
+    with open(input_path, "rb") as f:
+        file_size = os.fstat(f.fileno()).st_size
+        desired_num_chunks = 1
+        if num_workers > 1:
+            desired_num_chunks = max(
+                num_workers, math.ceil(file_size / _MAX_CHUNK_BYTES)
+            )
+        boundaries = find_chunk_boundaries(
+            f, desired_num_chunks, encoded_special_tokens
+        )
+
+    jobs = [
+        (input_path, start, end, special_tokens)
+        for start, end in zip(boundaries[:-1], boundaries[1:])
+    ]
+    if num_workers <= 1 or len(jobs) == 1:
+        counts: Counter[str] = Counter()
+        for job in jobs:
+            counts.update(_count_chunk(job))
+        return counts
+
+    counts = Counter()
+    with Pool(min(num_workers, len(jobs))) as pool:
+        for chunk_counts in pool.imap_unordered(_count_chunk, jobs):
+            counts.update(chunk_counts)
+    return counts
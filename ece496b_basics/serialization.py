@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+
+import os
+from typing import IO, BinaryIO, Optional
+
+import torch
+
+from .data import EpochSampler
+
+
+def save_checkpoint(
+    model: torch.nn.Module,
+    optimizer: torch.optim.Optimizer,
+    iteration: int,
+    out: str | os.PathLike | BinaryIO | IO[bytes],
+    sampler: Optional[EpochSampler] = None,
+) -> None:
+    """Serialize the model and optimizer state, the iteration and, if given, the
+    position of the data sampler to `out`."""
+    checkpoint = {
+        "model": model.state_dict(),
+        "optimizer": optimizer.state_dict(),
+        "iteration": iteration,
+    }
+    if sampler is not None:
+        checkpoint["sampler"] = sampler.state_dict()
+    torch.save(checkpoint, out)
+
+
+def load_checkpoint(
+    src: str | os.PathLike | BinaryIO | IO[bytes],
+    model: torch.nn.Module,
+    optimizer: torch.optim.Optimizer,
+    sampler: Optional[EpochSampler] = None,
+) -> int:
+    """Restore a checkpoint written by `save_checkpoint` into `model`, `optimizer` and
+    `sampler`, and return the saved iteration.
+
+    Raises:
+        ValueError: if a sampler is given but the checkpoint holds no sampler state.
+    """
+    checkpoint = torch.load(src)
+    model.load_state_dict(checkpoint["model"])
+    optimizer.load_state_dict(checkpoint["optimizer"])
+    if sampler is not None:
+        if "sampler" not in checkpoint:
+            raise ValueError("Checkpoint was saved without sampler state")
+        sampler.load_state_dict(checkpoint["sampler"])
+    return checkpoint["iteration"]
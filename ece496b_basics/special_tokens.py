@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+
+from typing import Iterator
+
+import regex as re
+
+# Trie key marking the end of a special token. Never collides with a character.
+_END = ""
+
+
+class SpecialTokenMatcher:
+    """Finds special tokens in text with a character trie.
+
+    Matches are leftmost-longest and non-overlapping, the same as a regex
+    alternation of the tokens sorted by decreasing length (so `<|endoftext|><|endoftext|>`
+    wins over `<|endoftext|>`). Candidate start positions are located by a single
+    regex character class over the first characters of all tokens, and the trie is
+    only walked from those positions. The cost therefore depends on the text and
+    the length of the longest match, not on the number of special tokens.
+
+    Args:
+        special_tokens: list[str]
+            Special tokens to match. Empty strings are ignored.
+    """
+
+    def __init__(self, special_tokens: list[str]):
+        self.root: dict = {}
+        for token in special_tokens:
+            if not token:
+                continue
+            node = self.root
+            for char in token:
+                node = node.setdefault(char, {})
+            node[_END] = token
+        self.max_len = max((len(token) for token in special_tokens), default=0)
+        first_chars = "".join(re.escape(char) for char in sorted(self.root))
+        self._start_re = re.compile(f"[{first_chars}]") if first_chars else None
+
+    def __bool__(self) -> bool:
+        return bool(self.root)
+
+    def match_at(self, text: str, pos: int) -> int | None:
+        """Return the end of the longest special token starting at `pos`, if any."""
+        node = self.root
+        end = None
+        for i in range(pos, len(text)):
+            node = node.get(text[i])
+            if node is None:
+                break
+            if _END in node:
+                end = i + 1
+        return end
+
+    def extends_past_end(self, text: str, pos: int) -> bool:
+        """Whether `text[pos:]` followed by more text could still be (part of) a longer
+        special token, i.e., `text[pos:]` is a prefix of some special token other
+        than itself."""
+        node = self.root
+        for i in range(pos, len(text)):
+            node = node.get(text[i])
+            if node is None:
+                return False
+        return any(key != _END for key in node)
+
+    def partial_match_start(self, text: str, pos: int = 0) -> int | None:
+        """Return the smallest `i >= pos` for which `extends_past_end(text, i)`.
+
+        When `text` is a prefix of a stream, this is where the stream has to be held
+        back: a special token may start at `i` and continue in the next chunk.
+        """
+        if self._start_re is None:
+            return None
+        pos = max(pos, len(text) - self.max_len + 1, 0)
+        while True:
+            candidate = self._start_re.search(text, pos)
+            if candidate is None:
+                return None
+            if self.extends_past_end(text, candidate.start()):
+                return candidate.start()
+            pos = candidate.start() + 1
+
+    def finditer(self, text: str, pos: int = 0) -> Iterator[tuple[int, int]]:
+        """Yield `(start, end)` spans of the special tokens in `text[pos:]`."""
+        if self._start_re is None:
+            return
+        search = self._start_re.search
+        while True:
+            candidate = search(text, pos)
+            if candidate is None:
+                return
+            start = candidate.start()
+            end = self.match_at(text, start)
+            if end is None:
+                pos = start + 1
+                continue
+            yield start, end
+            pos = end
@@ -0,0 +1,584 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+
+import codecs
+import json
+import math
+import os
+import struct
+from collections import OrderedDict
+from functools import cached_property
+from multiprocessing import Pool
+from typing import Iterable, Iterator, NamedTuple, Optional
+
+import numpy as np
+import regex as re
+
+from .pretokenization import PAT, find_chunk_boundaries
+from .special_tokens import SpecialTokenMatcher
+
+_PAT_RE = re.compile(PAT)
+
+# Target size of the file shards encoded by each worker in `Tokenizer.encode_file`.
+_SHARD_BYTES = 16 * 1024 * 1024
+
+# Header of the binary format written by `Tokenizer.save`: magic, number of token
+# ids, number of merges, size of the special-token JSON, size of the vocab blob.
+_ARTIFACT_MAGIC = b"BPETOK01"
+_ARTIFACT_HEADER = struct.Struct("<8sQQQQ")
+
+# Below this many ids, `decode_bytes` joins the tokens directly, as the fixed
+# overhead of the vectorized gather dominates.
+_SHORT_DECODE_LEN = 32
+
+# Tokenizer used by pool workers, set once per worker by `_init_worker`.
+_worker_tokenizer: Optional["Tokenizer"] = None
+
+
+def _init_worker(tokenizer: "Tokenizer") -> None:
+    global _worker_tokenizer
+    _worker_tokenizer = tokenizer
+
+
+def _encode_in_worker(text: str) -> list[int]:
+    return _worker_tokenizer.encode(text)
+
+
+def _encode_shard(
+    tokenizer: "Tokenizer",
+    input_path: str | os.PathLike,
+    start: int,
+    end: int,
+    dtype: np.dtype,
+) -> np.ndarray:
+    with open(input_path, "rb") as f:
+        f.seek(start)
+        text = f.read(end - start).decode("utf-8", errors="replace")
+    return np.array(tokenizer.encode(text), dtype=dtype)
+
+
+def _encode_shard_in_worker(
+    args: tuple[str | os.PathLike, int, int, np.dtype],
+) -> np.ndarray:
+    return _encode_shard(_worker_tokenizer, *args)
+
+
+class CacheInfo(NamedTuple):
+    hits: int
+    misses: int
+    maxsize: int
+    currsize: int
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+class Tokenizer:
+    """Byte-level BPE tokenizer.
+
+    Merges are applied by rank: `merge_ranks` maps a pair of token ids to the
+    position of that merge in `merges`, so finding the next merge for a pre-token is
+    a dict lookup per adjacent pair instead of a scan over the merge list.
+    Since natural text is Zipfian, the ids of recently seen pre-tokens are kept in
+    a bounded LRU cache (see `cache_info`).
+
+    Args:
+        vocab: dict[int, bytes]
+            Mapping from token id to token bytes.
+        merges: list[tuple[bytes, bytes]]
+            BPE merges, ordered by order of creation.
+        special_tokens: Optional[list[str]]
+            Strings that are always encoded as a single token. Special tokens missing
+            from `vocab` are appended to it.
+        cache_size: int, default is 16384
+            Maximum number of pre-tokens kept in the LRU cache. 0 disables caching.
+    """
+
+    def __init__(
+        self,
+        vocab: dict[int, bytes],
+        merges: list[tuple[bytes, bytes]],
+        special_tokens: Optional[list[str]] = None,
+        cache_size: int = 2**14,
+    ):
+        self.vocab = dict(vocab)
+        self.merges = list(merges)
+        self.byte_to_id = {token: token_id for token_id, token in self.vocab.items()}
+        for special_token in special_tokens or []:
+            encoded = special_token.encode("utf-8")
+            if encoded not in self.byte_to_id:
+                new_id = max(self.vocab, default=-1) + 1
+                self.vocab[new_id] = encoded
+                self.byte_to_id[encoded] = new_id
+        special_ids = {
+            special_token: self.byte_to_id[special_token.encode("utf-8")]
+            for special_token in special_tokens or []
+        }
+
+        # All token bytes concatenated in id order; token i is
+        # `vocab_blob[vocab_offsets[i] : vocab_offsets[i + 1]]`.
+        num_ids = max(self.vocab, default=-1) + 1
+        lengths = np.zeros(num_ids, dtype=np.int64)
+        for token_id, token in self.vocab.items():
+            lengths[token_id] = len(token)
+        vocab_offsets = np.zeros(num_ids + 1, dtype=np.int64)
+        np.cumsum(lengths, out=vocab_offsets[1:])
+        blob = b"".join(self.vocab.get(token_id, b"") for token_id in range(num_ids))
+        vocab_blob = np.frombuffer(blob, dtype=np.uint8)
+
+        # (first id, second id, merged id) for every merge, in rank order.
+        # The merged id is -1 if the concatenation is not in the vocab.
+        merge_ids = np.array(
+            [
+                (
+                    self.byte_to_id[first],
+                    self.byte_to_id[second],
+                    self.byte_to_id.get(first + second, -1),
+                )
+                for first, second in self.merges
+            ],
+            dtype=np.int32,
+        ).reshape(-1, 3)
+        self._init_tables(vocab_offsets, vocab_blob, merge_ids, special_ids, cache_size)
+
+    def _init_tables(
+        self,
+        vocab_offsets: np.ndarray,
+        vocab_blob: np.ndarray,
+        merge_ids: np.ndarray,
+        special_ids: dict[str, int],
+        cache_size: int,
+    ) -> None:
+        self.vocab_offsets = vocab_offsets
+        self.vocab_blob = vocab_blob
+        self._merge_ids = merge_ids
+        self.special_ids = special_ids
+        self.special_tokens = list(special_ids)
+        self._special_matcher = SpecialTokenMatcher(self.special_tokens)
+
+        single_byte_ids = np.flatnonzero(np.diff(vocab_offsets) == 1)
+        byte_values = vocab_blob[vocab_offsets[single_byte_ids]]
+        byte_ids: dict[int, int] = {}
+        for byte_value, token_id in zip(byte_values.tolist(), single_byte_ids.tolist()):
+            byte_ids.setdefault(byte_value, token_id)
+        self._byte_ids = [byte_ids[b] for b in range(256)]
+
+        self.cache_size = cache_size
+        self._cache: OrderedDict[str, tuple[int, ...]] = OrderedDict()
+        self._cache_hits = 0
+        self._cache_misses = 0
+
+    # The tables below are derived from the flat arrays. `__init__` sets the first
+    # three directly; for a tokenizer from `load` all of them are built on first use,
+    # so that loading itself only maps the file.
+
+    @cached_property
+    def vocab(self) -> dict[int, bytes]:
+        blob = self.vocab_blob.tobytes()
+        bounds = self.vocab_offsets.tolist()
+        return {
+            token_id: blob[start:end]
+            for token_id, (start, end) in enumerate(zip(bounds, bounds[1:]))
+            if end > start
+        }
+
+    @cached_property
+    def byte_to_id(self) -> dict[bytes, int]:
+        return {token: token_id for token_id, token in self.vocab.items()}
+
+    @cached_property
+    def merges(self) -> list[tuple[bytes, bytes]]:
+        vocab = self.vocab
+        return [(vocab[first], vocab[second]) for first, second, _ in self._merge_ids]
+
+    @cached_property
+    def _merge_table(
+        self,
+    ) -> tuple[dict[tuple[int, int], int], dict[tuple[int, int], int]]:
+        """(pair -> rank, pair -> merged id); the first merge of a pair wins."""
+        merge_ranks: dict[tuple[int, int], int] = {}
+        merged_ids: dict[tuple[int, int], int] = {}
+        for rank, (first, second, merged_id) in enumerate(self._merge_ids.tolist()):
+            pair = (first, second)
+            if merged_id >= 0 and pair not in merge_ranks:
+                merge_ranks[pair] = rank
+                merged_ids[pair] = merged_id
+        return merge_ranks, merged_ids
+
+    @property
+    def merge_ranks(self) -> dict[tuple[int, int], int]:
+        return self._merge_table[0]
+
+    def save(self, path: str | os.PathLike) -> None:
+        """Write the tokenizer to a single binary file that `Tokenizer.load` maps
+        into memory.
+
+        Layout (little-endian): a header (magic, number of token ids, number of
+        merges, size of the special-token JSON, size of the vocab blob), then
+        `vocab_offsets` as int64, the (first, second, merged) merge ids as int32,
+        the special tokens and their ids as UTF-8 JSON, and finally `vocab_blob`.
+        Sections are padded to 8 bytes so the arrays can be viewed in place.
+        """
+        special_json = json.dumps(list(self.special_ids.items())).encode("utf-8")
+        sections = [
+            self.vocab_offsets.astype("<i8").tobytes(),
+            self._merge_ids.astype("<i4").tobytes(),
+            special_json,
+            self.vocab_blob.tobytes(),
+        ]
+        tmp_path = f"{os.fspath(path)}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(
+                _ARTIFACT_HEADER.pack(
+                    _ARTIFACT_MAGIC,
+                    len(self.vocab_offsets) - 1,
+                    len(self._merge_ids),
+                    len(special_json),
+                    self.vocab_blob.nbytes,
+                )
+            )
+            for section in sections:
+                f.write(section)
+                f.write(b"\0" * (-len(section) % 8))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str | os.PathLike, cache_size: int = 2**14) -> "Tokenizer":
+        """Load a tokenizer written by `save`.
+
+        The file is memory-mapped read-only, and `vocab_blob`, `vocab_offsets` and
+        the merge ids are views into the mapping, so forked workers share those
+        pages. No JSON vocab parsing or GPT-2 byte remapping happens; the Python
+        lookup tables (vocab dict, merge ranks) are built lazily on first use.
+        """
+        data = np.memmap(path, dtype=np.uint8, mode="r")
+        magic, num_ids, num_merges, special_size, blob_size = (
+            _ARTIFACT_HEADER.unpack_from(data)
+        )
+        if magic != _ARTIFACT_MAGIC:
+            raise ValueError(
+                f"{path} is not a tokenizer file written by Tokenizer.save"
+            )
+
+        def take(nbytes: int) -> np.ndarray:
+            nonlocal offset
+            section = data[offset : offset + nbytes]
+            offset += nbytes + (-nbytes % 8)
+            return section
+
+        offset = _ARTIFACT_HEADER.size
+        vocab_offsets = take(8 * (num_ids + 1)).view("<i8")
+        merge_ids = take(4 * 3 * num_merges).view("<i4").reshape(-1, 3)
+        special_ids = dict(json.loads(take(special_size).tobytes().decode("utf-8")))
+        vocab_blob = take(blob_size)
+
+        tokenizer = cls.__new__(cls)
+        tokenizer._init_tables(
+            vocab_offsets, vocab_blob, merge_ids, special_ids, cache_size
+        )
+        return tokenizer
+
+    def cache_info(self) -> CacheInfo:
+        """Hit/miss statistics and current size of the pre-token cache."""
+        return CacheInfo(
+            self._cache_hits, self._cache_misses, self.cache_size, len(self._cache)
+        )
+
+    def cache_clear(self) -> None:
+        self._cache.clear()
+        self._cache_hits = self._cache_misses = 0
+
+    def _bpe(self, pretoken: bytes) -> tuple[int, ...]:
+        ids = [self._byte_ids[b] for b in pretoken]
+        ranks, merged_ids = self._merge_table
+        while len(ids) > 1:
+            best_pair = None
+            best_rank = None
+            for pair in zip(ids, ids[1:]):
+                rank = ranks.get(pair)
+                if rank is not None and (best_rank is None or rank < best_rank):
+                    best_pair, best_rank = pair, rank
+            if best_pair is None:
+                break
+            first, second = best_pair
+            merged_id = merged_ids[best_pair]
+            merged = []
+            i = 0
+            while i < len(ids):
+                if i + 1 < len(ids) and ids[i] == first and ids[i + 1] == second:
+                    merged.append(merged_id)
+                    i += 2
+                else:
+                    merged.append(ids[i])
+                    i += 1
+            ids = merged
+        return tuple(ids)
+
+    def _encode_pretoken(self, pretoken: str) -> tuple[int, ...]:
+        cache = self._cache
+        ids = cache.get(pretoken)
+        if ids is not None:
+            self._cache_hits += 1
+            cache.move_to_end(pretoken)
+            return ids
+        self._cache_misses += 1
+        ids = self._bpe(pretoken.encode("utf-8"))
+        if self.cache_size > 0:
+            cache[pretoken] = ids
+            if len(cache) > self.cache_size:
+                cache.popitem(last=False)
+        return ids
+
+    def _encode_ordinary(self, text: str, ids: list[int]) -> None:
+        for pretoken in _PAT_RE.findall(text):
+            ids.extend(self._encode_pretoken(pretoken))
+
+    def _encode_prefix(self, text: str, ids: list[int], final: bool) -> int:
+        """Encode as much of `text` as can be encoded without seeing what follows it,
+        appending the ids to `ids`. Returns the number of characters consumed.
+
+        If `final`, `text` is the whole input and is consumed entirely. Otherwise
+        `text` is a prefix of a stream, and two things are held back: any tail that
+        may still grow into a special token, including one that starts before a
+        complete but shorter special token, and the last two pre-tokens of the
+        trailing ordinary text. The last one may continue in the next chunk, and the
+        one before it may still change: a contraction split after its apostrophe
+        (e.g. "I'l" + "l") pre-tokenizes as "'" and "l" until the chunk that
+        completes "'ll" arrives. All earlier pre-tokens are final. They are taken
+        from the pre-tokenization of the whole buffer, not of a truncated copy,
+        because the whitespace alternative of PAT (`\\s+(?!\\S)`) looks one
+        character ahead.
+        """
+        matcher = self._special_matcher
+        start = 0
+        held = len(text)
+        for special_start, special_end in matcher.finditer(text):
+            if not final:
+                # A special token cut off at the end of `text` wins over a complete
+                # one that starts later, e.g. "<|endo" + "ftext|>" over "endo".
+                partial_start = matcher.partial_match_start(text, start)
+                if partial_start is not None and partial_start <= special_start:
+                    held = partial_start
+                    break
+            self._encode_ordinary(text[start:special_start], ids)
+            ids.append(self.special_ids[text[special_start:special_end]])
+            start = special_end
+        else:
+            if not final:
+                partial_start = matcher.partial_match_start(text, start)
+                if partial_start is not None:
+                    held = partial_start
+
+        if final:
+            self._encode_ordinary(text[start:], ids)
+            return len(text)
+        pretokens = _PAT_RE.findall(text[start:held])
+        if len(pretokens) <= 2:
+            return start
+        for pretoken in pretokens[:-2]:
+            ids.extend(self._encode_pretoken(pretoken))
+        return held - len(pretokens[-1]) - len(pretokens[-2])
+
+    def encode(self, text: str) -> list[int]:
+        """Encode `text` into a list of token ids."""
+        ids: list[int] = []
+        self._encode_prefix(text, ids, final=True)
+        return ids
+
+    def _encode_stream(self, iterable: Iterable[str]) -> Iterator[list[int]]:
+        buffer = ""
+        for chunk in iterable:
+            buffer += chunk
+            ids: list[int] = []
+            consumed = self._encode_prefix(buffer, ids, final=False)
+            buffer = buffer[consumed:]
+            if ids:
+                yield ids
+        ids = []
+        self._encode_prefix(buffer, ids, final=True)
+        if ids:
+            yield ids
+
+    def encode_iterable(self, iterable: Iterable[str]) -> Iterator[int]:
+        """Lazily encode an iterable of strings (e.g., a file handle).
+
+        Chunks may split a pre-token or a special token anywhere. Only the last two
+        pre-tokens (or a partial special token) are buffered between chunks,
+        so memory does not grow with the input or its line lengths, and the ids
+        are the same as `encode` on the concatenated text.
+        """
+        for ids in self._encode_stream(iterable):
+            yield from ids
+
+    def encode_iterable_batched(
+        self, iterable: Iterable[str], batch_size: int = 2**16
+    ) -> Iterator[np.ndarray]:
+        """Like `encode_iterable`, but yields the ids as NumPy arrays (of dtype
+        `token_dtype`) of `batch_size` ids each, except for a shorter last batch."""
+        dtype = self.token_dtype
+        pending: list[int] = []
+        for ids in self._encode_stream(iterable):
+            pending.extend(ids)
+            while len(pending) >= batch_size:
+                yield np.array(pending[:batch_size], dtype=dtype)
+                del pending[:batch_size]
+        if pending:
+            yield np.array(pending, dtype=dtype)
+
+    @property
+    def token_dtype(self) -> np.dtype:
+        """Smallest unsigned integer dtype that can hold every token id."""
+        return np.dtype(
+            np.uint16 if len(self.vocab_offsets) - 1 <= 2**16 else np.uint32
+        )
+
+    def encode_batch(
+        self, texts: list[str], num_workers: Optional[int] = None
+    ) -> list[list[int]]:
+        """Encode each text in `texts`, spreading the work over a process pool.
+
+        Args:
+            texts: list[str]
+                Texts to encode independently.
+            num_workers: Optional[int]
+                Number of worker processes. Defaults to `os.cpu_count()`.
+                With a single worker the texts are encoded in this process.
+
+        Returns:
+            One list of token ids per text, in the same order as `texts`.
+        """
+        if num_workers is None:
+            num_workers = os.cpu_count() or 1
+        if num_workers <= 1 or len(texts) <= 1:
+            return [self.encode(text) for text in texts]
+        chunksize = max(1, len(texts) // (4 * num_workers))
+        with Pool(num_workers, initializer=_init_worker, initargs=(self,)) as pool:
+            return pool.map(_encode_in_worker, texts, chunksize=chunksize)
+
+    def encode_file(
+        self,
+        input_path: str | os.PathLike,
+        out_path: str | os.PathLike,
+        num_workers: Optional[int] = None,
+    ) -> int:
+        """Encode a UTF-8 text file into a flat array of token ids on disk.
+
+        The file is sharded at special-token boundaries (see
+        `find_chunk_boundaries`), so the shards can be encoded independently in
+        worker processes, and the shard outputs are written in file order. The ids
+        are identical to `encode` on the whole text. Without special tokens the
+        file is encoded as a single shard.
+
+        The ids are stored with `token_dtype` (uint16 for vocabularies of up to 65536
+        tokens, uint32 otherwise). If `out_path` ends with `.npy` it is written in
+        NumPy format, loadable with `np.load(out_path, mmap_mode="r")`; otherwise
+        the raw ids are written.
+
+        Returns:
+            Number of tokens written.
+        """
+        if num_workers is None:
+            num_workers = os.cpu_count() or 1
+        dtype = self.token_dtype
+        special_tokens = [token.encode("utf-8") for token in self.special_tokens]
+        with open(input_path, "rb") as f:
+            file_size = os.fstat(f.fileno()).st_size
+            desired_num_shards = max(num_workers, math.ceil(file_size / _SHARD_BYTES))
+            boundaries = find_chunk_boundaries(f, desired_num_shards, special_tokens)
+        jobs = [
+            (input_path, start, end, dtype)
+            for start, end in zip(boundaries[:-1], boundaries[1:])
+        ]
+
+        out_path = os.fspath(out_path)
+        raw_path = out_path + ".tmp" if out_path.endswith(".npy") else out_path
+        num_tokens = 0
+        with open(raw_path, "wb") as out:
+            if num_workers <= 1 or len(jobs) == 1:
+                for job in jobs:
+                    shard = _encode_shard(self, *job)
+                    out.write(shard.tobytes())
+                    num_tokens += len(shard)
+            else:
+                with Pool(
+                    min(num_workers, len(jobs)),
+                    initializer=_init_worker,
+                    initargs=(self,),
+                ) as pool:
+                    for shard in pool.imap(_encode_shard_in_worker, jobs):
+                        out.write(shard.tobytes())
+                        num_tokens += len(shard)
+
+        if raw_path != out_path and num_tokens == 0:
+            np.save(out_path, np.empty(0, dtype=dtype))
+            os.remove(raw_path)
+        elif raw_path != out_path:
+            ids = np.memmap(raw_path, dtype=dtype, mode="r", shape=(num_tokens,))
+            array = np.lib.format.open_memmap(
+                out_path, mode="w+", dtype=dtype, shape=(num_tokens,)
+            )
+            block = _SHARD_BYTES // dtype.itemsize
+            for start in range(0, num_tokens, block):
+                array[start : start + block] = ids[start : start + block]
+            array.flush()
+            del ids, array
+            os.remove(raw_path)
+        return num_tokens
+
+    def decode_bytes(self, ids) -> bytes:
+        """Concatenate the bytes of the given token ids.
+
+        `ids` may be a list of ints, a NumPy array or a torch tensor. The token
+        byte ranges are gathered from `vocab_blob` with one vectorized index
+        computation instead of one Python-level lookup per token.
+
+        Raises:
+            KeyError: if an id is not in the vocab, whatever the type or length of
+                `ids`.
+        """
+        if isinstance(ids, (list, tuple)) and len(ids) < _SHORT_DECODE_LEN:
+            return b"".join([self.vocab[i] for i in ids])
+        if hasattr(ids, "detach"):
+            ids = ids.detach().cpu().numpy()
+        ids = np.asarray(ids, dtype=np.int64).reshape(-1)
+        if ids.size == 0:
+            return b""
+        # Out-of-range ids would otherwise index (or, if negative, wrap around)
+        # `vocab_offsets`, and ids missing from a vocab with gaps have no bytes.
+        invalid = np.flatnonzero((ids < 0) | (ids >= len(self.vocab_offsets) - 1))
+        if invalid.size:
+            raise KeyError(int(ids[invalid[0]]))
+        starts = self.vocab_offsets[ids]
+        lengths = self.vocab_offsets[ids + 1] - starts
+        if not lengths.all():
+            raise KeyError(int(ids[np.argmin(lengths)]))
+        # Position j of the output reads blob[starts[k] + (j - out_starts[k])],
+        # where k is the token that output byte j belongs to.
+        out_starts = np.cumsum(lengths) - lengths
+        positions = np.arange(int(lengths.sum()), dtype=np.int64)
+        positions += np.repeat(starts - out_starts, lengths)
+        return self.vocab_blob[positions].tobytes()
+
+    def decode(self, ids) -> str:
+        """Decode token ids (a list, NumPy array or torch tensor) into text,
+        replacing invalid UTF-8 with U+FFFD."""
+        return self.decode_bytes(ids).decode("utf-8", errors="replace")
+
+    def decode_stream(self, ids: Iterable[int]) -> Iterator[str]:
+        """Incrementally decode a stream of token ids (e.g., from a sampling loop).
+
+        Bytes of a multi-byte UTF-8 character that is split across tokens are held
+        back until the character is complete, so the yielded text never contains a
+        replacement character in the middle of a code point. Genuinely invalid
+        UTF-8 is still replaced with U+FFFD.
+        """
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        for token_id in ids:
+            text = decoder.decode(self.vocab[int(token_id)])
+            if text:
+                yield text
+        text = decoder.decode(b"", final=True)
+        if text:
+            yield text
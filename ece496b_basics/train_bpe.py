@@ -0,0 +1,465 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+
+import heapq
+import logging
+import os
+import pickle
+import time
+from array import array
+from collections import Counter, defaultdict
+from typing import Iterable, Optional, Sequence, Union
+
+import numpy as np
+
+from .memory import peak_rss_mb
+from .pretoken_cache import PretokenCache, pretoken_cache_key
+from .pretokenization import count_pretokens
+
+logger = logging.getLogger(__name__)
+
+
+def _initial_vocab(special_tokens: list[str]) -> dict[int, bytes]:
+    """Special tokens first, followed by the 256 single-byte tokens."""
+    vocab: dict[int, bytes] = {}
+    for token in special_tokens:
+        vocab[len(vocab)] = token.encode("utf-8")
+    for b in range(256):
+        vocab[len(vocab)] = bytes([b])
+    return vocab
+
+
+def _merge_word(
+    word: tuple[int, ...], pair: tuple[int, int], new_id: int
+) -> tuple[int, ...]:
+    merged = []
+    i = 0
+    while i < len(word):
+        if i + 1 < len(word) and word[i] == pair[0] and word[i + 1] == pair[1]:
+            merged.append(new_id)
+            i += 2
+        else:
+            merged.append(word[i])
+            i += 1
+    return tuple(merged)
+
+
+class FlatWords:
+    """Compact storage for the unique pre-tokens of a corpus.
+
+    All words live in one flat int32 buffer of token ids, addressed by per-word
+    offsets and lengths. Merges only ever shorten a word, so `__setitem__` rewrites
+    the word in place and the buffer never grows. Word frequencies are kept in a
+    parallel int64 array (`counts`).
+    """
+
+    def __init__(self, pretoken_counts: Counter[str], byte_offset: int):
+        num_words = len(pretoken_counts)
+        # UTF-8 lengths without keeping an encoded copy of every pre-token around.
+        self.lengths = np.fromiter(
+            (
+                len(pretoken) if pretoken.isascii() else len(pretoken.encode("utf-8"))
+                for pretoken in pretoken_counts
+            ),
+            dtype=np.int32,
+            count=num_words,
+        )
+        self.offsets = np.zeros(num_words, dtype=np.int64)
+        np.cumsum(self.lengths[:-1], out=self.offsets[1:])
+        encoded = "".join(pretoken_counts).encode("utf-8")
+        self.buffer = np.frombuffer(encoded, dtype=np.uint8).astype(np.int32)
+        del encoded
+        self.buffer += byte_offset
+        self.counts = np.fromiter(
+            pretoken_counts.values(), dtype=np.int64, count=num_words
+        )
+
+    def __len__(self) -> int:
+        return len(self.lengths)
+
+    def __getitem__(self, i: int) -> tuple[int, ...]:
+        start = self.offsets[i]
+        return tuple(self.buffer[start : start + self.lengths[i]].tolist())
+
+    def __setitem__(self, i: int, word: Sequence[int]) -> None:
+        if len(word) > self.lengths[i]:
+            raise ValueError("FlatWords only supports shrinking a word in place")
+        start = self.offsets[i]
+        self.buffer[start : start + len(word)] = word
+        self.lengths[i] = len(word)
+
+    @property
+    def nbytes(self) -> int:
+        return (
+            self.buffer.nbytes
+            + self.offsets.nbytes
+            + self.lengths.nbytes
+            + self.counts.nbytes
+        )
+
+
+# The heap is rebuilt once it holds this many entries per live pair.
+_HEAP_SLACK = 2
+
+
+class _Descending:
+    """Wraps a value so that `heapq` (a min-heap) pops the greatest value first."""
+
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other: "_Descending") -> bool:
+        return self.value > other.value
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, _Descending) and self.value == other.value
+
+
+class PairIndex:
+    """Incrementally maintained pair statistics for the BPE merge loop.
+
+    Keeps the count of every adjacent token pair, an index from each pair to the
+    words that contain it, and a max-heap keyed on (count, byte pair) for picking
+    the next merge. After a merge only the words containing the merged pair are
+    rewritten, and only the counts of pairs they touch are updated.
+
+    The heap is updated lazily. Every live pair has an entry whose count is at least
+    its current count: a fresh entry is pushed only when a pair's count grows, and an
+    entry whose pair has since shrunk is reinserted at the current count when it
+    reaches the top (entries of dead or grown pairs are dropped). Once stale entries
+    make up most of the heap, it is rebuilt from `pair_counts`.
+
+    The word index holds a set of word ids per pair, from which a rewritten word is
+    removed for the pairs it loses. With `compact`, it holds int32 arrays instead,
+    which are far smaller than sets but append-only: a word may stay listed under a
+    pair it no longer contains, which `merge` detects and skips.
+    """
+
+    def __init__(
+        self,
+        words: Union[list[tuple[int, ...]], FlatWords],
+        counts: Union[list[int], np.ndarray],
+        vocab: dict[int, bytes],
+        compact: bool = False,
+    ):
+        self.words = words
+        self.counts = counts
+        self.vocab = vocab
+        self.compact = compact
+        self.pair_counts: dict[tuple[int, int], int] = defaultdict(int)
+        self.pair_words: dict[tuple[int, int], set[int] | array] = defaultdict(
+            (lambda: array("i")) if compact else set
+        )
+        for i in range(len(words)):
+            word = words[i]
+            count = int(counts[i])
+            for pair in zip(word, word[1:]):
+                self.pair_counts[pair] += count
+            self._add_word(dict.fromkeys(zip(word, word[1:])), i)
+        self._rebuild_heap()
+
+    def __getstate__(self):
+        # The heap is fully determined by `pair_counts`; rebuild it on load instead
+        # of serializing its stale entries. The defaultdict factories are lambdas,
+        # which do not pickle.
+        state = self.__dict__.copy()
+        del state["heap"]
+        state["pair_counts"] = dict(self.pair_counts)
+        state["pair_words"] = dict(self.pair_words)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # Snapshots written before the compact word index have sets.
+        self.__dict__.setdefault("compact", False)
+        self.pair_counts = defaultdict(int, self.pair_counts)
+        self.pair_words = defaultdict(
+            (lambda: array("i")) if self.compact else set, self.pair_words
+        )
+        self._rebuild_heap()
+
+    def _rebuild_heap(self) -> None:
+        self.heap = [
+            self._heap_entry(pair, count) for pair, count in self.pair_counts.items()
+        ]
+        heapq.heapify(self.heap)
+
+    def _add_word(self, pairs: Iterable[tuple[int, int]], i: int) -> None:
+        if self.compact:
+            for pair in pairs:
+                self.pair_words[pair].append(i)
+        else:
+            for pair in pairs:
+                self.pair_words[pair].add(i)
+
+    def _heap_entry(self, pair: tuple[int, int], count: int):
+        # Ties are broken by the lexicographically greater byte pair.
+        return (-count, _Descending((self.vocab[pair[0]], self.vocab[pair[1]])), pair)
+
+    def best_pair(self) -> Optional[tuple[int, int]]:
+        """Return the most frequent pair, or None if no pairs remain."""
+        while self.heap:
+            neg_count, _, pair = self.heap[0]
+            count = self.pair_counts.get(pair, 0)
+            if count == -neg_count:
+                return pair
+            if 0 < count < -neg_count:
+                heapq.heapreplace(self.heap, self._heap_entry(pair, count))
+            else:
+                heapq.heappop(self.heap)
+        return None
+
+    def merge(self, pair: tuple[int, int], new_id: int) -> None:
+        """Replace every occurrence of `pair` with `new_id` and update the statistics."""
+        # Count of every touched pair before this merge.
+        previous: dict[tuple[int, int], int] = {}
+        for i in self.pair_words.pop(pair, ()):
+            word = self.words[i]
+            merged = _merge_word(word, pair, new_id)
+            if len(merged) == len(word):
+                continue
+            count = int(self.counts[i])
+            old_pairs = dict.fromkeys(zip(word, word[1:]))
+            new_pairs = dict.fromkeys(zip(merged, merged[1:]))
+            for old_pair in zip(word, word[1:]):
+                previous.setdefault(old_pair, self.pair_counts[old_pair])
+                self.pair_counts[old_pair] -= count
+            for new_pair in zip(merged, merged[1:]):
+                previous.setdefault(new_pair, self.pair_counts[new_pair])
+                self.pair_counts[new_pair] += count
+            if not self.compact:
+                for old_pair in old_pairs.keys() - new_pairs.keys():
+                    word_ids = self.pair_words.get(old_pair)
+                    if word_ids is not None:
+                        word_ids.discard(i)
+            self._add_word((p for p in new_pairs if p not in old_pairs), i)
+            self.words[i] = merged
+
+        for changed_pair, previous_count in previous.items():
+            count = self.pair_counts[changed_pair]
+            if count <= 0:
+                del self.pair_counts[changed_pair]
+                self.pair_words.pop(changed_pair, None)
+            elif count > previous_count:
+                heapq.heappush(self.heap, self._heap_entry(changed_pair, count))
+        if len(self.heap) > _HEAP_SLACK * len(self.pair_counts) + 1024:
+            self._rebuild_heap()
+
+
+def _build_pair_index(
+    input_path: str | os.PathLike,
+    special_tokens: list[str],
+    num_workers: Optional[int],
+    compact: bool,
+    pretoken_cache: Optional[PretokenCache],
+    cache_key: Optional[str],
+    timings: dict[str, float],
+) -> PairIndex:
+    start = time.perf_counter()
+    vocab = _initial_vocab(special_tokens)
+    byte_offset = len(special_tokens)
+    pretoken_counts = None
+    if pretoken_cache is not None:
+        pretoken_counts = pretoken_cache.get(cache_key)
+        if pretoken_counts is not None:
+            logger.info("Loaded pre-token counts from cache entry %s", cache_key)
+    if pretoken_counts is None:
+        pretoken_counts = count_pretokens(
+            input_path, special_tokens, num_workers=num_workers
+        )
+        if pretoken_cache is not None:
+            pretoken_cache.put(cache_key, pretoken_counts)
+    timings["pretokenization"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    if compact:
+        words = FlatWords(pretoken_counts, byte_offset)
+        counts = words.counts
+        logger.info(
+            "Stored %d unique pre-tokens in %.1f MB", len(words), words.nbytes / 2**20
+        )
+    else:
+        words = [
+            tuple(byte_offset + b for b in pretoken.encode("utf-8"))
+            for pretoken in pretoken_counts
+        ]
+        counts = list(pretoken_counts.values())
+    del pretoken_counts
+    index = PairIndex(words, counts, vocab, compact=compact)
+    timings["initial_pair_counting"] = time.perf_counter() - start
+    return index
+
+
+def _input_fingerprint(
+    input_path: str | os.PathLike, special_tokens: list[str]
+) -> dict:
+    # The digest covers the corpus contents, the pre-tokenization pattern and the
+    # special tokens, and doubles as the pre-token cache key.
+    return {
+        "input_digest": pretoken_cache_key(input_path, special_tokens),
+        "special_tokens": list(special_tokens),
+    }
+
+
+def save_training_snapshot(
+    path: str | os.PathLike,
+    index: PairIndex,
+    merges: list[tuple[bytes, bytes]],
+    fingerprint: dict,
+) -> None:
+    """Atomically write the BPE training state (word counts, pair index, vocab and
+    merges) to `path`, so a crash mid-write never leaves a truncated snapshot."""
+    tmp_path = f"{os.fspath(path)}.tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(
+            {"fingerprint": fingerprint, "index": index, "merges": merges},
+            f,
+            protocol=pickle.HIGHEST_PROTOCOL,
+        )
+    os.replace(tmp_path, path)
+
+
+def load_training_snapshot(
+    path: str | os.PathLike, fingerprint: dict
+) -> tuple[PairIndex, list[tuple[bytes, bytes]]]:
+    """Load a snapshot written by `save_training_snapshot`.
+
+    Raises:
+        ValueError: if the snapshot was taken on a different corpus (by contents),
+            pre-tokenization pattern or special tokens.
+    """
+    with open(path, "rb") as f:
+        state = pickle.load(f)
+    if state["fingerprint"] != fingerprint:
+        raise ValueError(
+            f"BPE snapshot {path} was taken with {state['fingerprint']}, "
+            f"which does not match the current run ({fingerprint})"
+        )
+    return state["index"], state["merges"]
+
+
+def train_bpe(
+    input_path: str | os.PathLike,
+    vocab_size: int,
+    special_tokens: list[str],
+    num_workers: Optional[int] = None,
+    compact: bool = False,
+    checkpoint_path: Optional[str | os.PathLike] = None,
+    checkpoint_every: int = 1000,
+    resume_from: Optional[str | os.PathLike] = None,
+    pretoken_cache_dir: Optional[str | os.PathLike] = None,
+    pretoken_cache_max_bytes: int = 4 * 2**30,
+    timings: Optional[dict[str, float]] = None,
+    merge_latencies: Optional[list[float]] = None,
+) -> tuple[dict[int, bytes], list[tuple[bytes, bytes]]]:
+    """Train a byte-level BPE tokenizer on the corpus at `input_path`.
+    The peak resident set size is logged at INFO level when training finishes.
+
+    Args:
+        input_path: str | os.PathLike
+            Path to BPE tokenizer training data.
+        vocab_size: int
+            Total number of items in the vocabulary (including special tokens).
+        special_tokens: list[str]
+            Special tokens to add to the vocabulary. The corpus is split on them
+            before pre-tokenization, so merges never cross a special token.
+        num_workers: Optional[int]
+            Number of processes used for pre-tokenization.
+            Defaults to `os.cpu_count()`.
+        compact: bool, default is False
+            Store the unique pre-tokens in a `FlatWords` buffer instead of a list of
+            tuples, and index the words of each pair with int32 arrays instead of
+            sets (see `PairIndex`), which uses far less memory on large corpora. The
+            output is identical in both modes.
+        checkpoint_path: Optional[str | os.PathLike]
+            If given, snapshot the training state to this path every
+            `checkpoint_every` merges and once more when training finishes.
+        checkpoint_every: int, default is 1000
+            Number of merges between snapshots.
+        resume_from: Optional[str | os.PathLike]
+            Snapshot to resume from. Pre-tokenization is skipped and merging continues
+            where the snapshot left off, producing the same vocab and merges as an
+            uninterrupted run. If the file does not exist, training starts from scratch.
+            Raises ValueError if the snapshot was taken on a corpus with different
+            contents, or with a different pattern or special tokens.
+            A finished run can also be resumed with a larger `vocab_size`.
+        pretoken_cache_dir: Optional[str | os.PathLike]
+            Directory of a `PretokenCache`. Pre-token counts are looked up by the
+            corpus contents, pre-tokenization pattern and special tokens, so repeated
+            runs on the same corpus (e.g., a vocab size sweep) skip pre-tokenization.
+        pretoken_cache_max_bytes: int, default is 4 GiB
+            Size bound of the pre-token cache; least recently used entries are evicted.
+        timings: Optional[dict[str, float]]
+            If given, filled with the seconds spent in each phase: "input_hashing"
+            (only with a snapshot option or `pretoken_cache_dir`), "pretokenization"
+            (or loading the counts from the cache) and "initial_pair_counting", or
+            "snapshot_loading" when resuming, then "merge_loop" and "checkpointing".
+        merge_latencies: Optional[list[float]]
+            If given, the seconds taken by every merge are appended to it.
+
+    Returns:
+        Tuple of (vocab, merges), as described in `tests/adapters.py::run_train_bpe`.
+    """
+    if timings is None:
+        timings = {}
+    # Hashing reads the whole corpus serially, so it is only done when a snapshot
+    # or the pre-token cache needs it.
+    fingerprint = None
+    if any(
+        option is not None
+        for option in (checkpoint_path, resume_from, pretoken_cache_dir)
+    ):
+        start = time.perf_counter()
+        fingerprint = _input_fingerprint(input_path, special_tokens)
+        timings["input_hashing"] = time.perf_counter() - start
+    if resume_from is not None and os.path.exists(resume_from):
+        start = time.perf_counter()
+        index, merges = load_training_snapshot(resume_from, fingerprint)
+        timings["snapshot_loading"] = time.perf_counter() - start
+        logger.info(
+            "Resuming BPE training from %s at merge %d", resume_from, len(merges)
+        )
+    else:
+        pretoken_cache = None
+        if pretoken_cache_dir is not None:
+            pretoken_cache = PretokenCache(pretoken_cache_dir, pretoken_cache_max_bytes)
+        index = _build_pair_index(
+            input_path,
+            special_tokens,
+            num_workers,
+            compact,
+            pretoken_cache,
+            fingerprint["input_digest"] if fingerprint is not None else None,
+            timings,
+        )
+        merges = []
+    vocab = index.vocab
+
+    checkpoint_seconds = 0.0
+    loop_start = time.perf_counter()
+    while len(vocab) < vocab_size:
+        merge_start = time.perf_counter()
+        best = index.best_pair()
+        if best is None:
+            break
+        new_id = len(vocab)
+        vocab[new_id] = vocab[best[0]] + vocab[best[1]]
+        merges.append((vocab[best[0]], vocab[best[1]]))
+        index.merge(best, new_id)
+        if merge_latencies is not None:
+            merge_latencies.append(time.perf_counter() - merge_start)
+        if checkpoint_path is not None and len(merges) % checkpoint_every == 0:
+            start = time.perf_counter()
+            save_training_snapshot(checkpoint_path, index, merges, fingerprint)
+            checkpoint_seconds += time.perf_counter() - start
+    timings["merge_loop"] = time.perf_counter() - loop_start - checkpoint_seconds
+
+    if checkpoint_path is not None:
+        start = time.perf_counter()
+        save_training_snapshot(checkpoint_path, index, merges, fingerprint)
+        checkpoint_seconds += time.perf_counter() - start
+    timings["checkpointing"] = checkpoint_seconds
+    logger.info("BPE training done, peak RSS %.1f MB", peak_rss_mb())
+    return vocab, merges
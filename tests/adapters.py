@@ -7,6 +7,23 @@ from typing import IO, BinaryIO, Iterable, Optional, Type
 import numpy.typing as npt
 import torch
 
+from ece496b_basics.data import get_batch
+from ece496b_basics.model import (
+    MultiHeadSelfAttention,
+    PositionwiseFeedForward,
+    RMSNorm,
+    TransformerBlock,
+    TransformerLM,
+    gelu,
+    scaled_dot_product_attention,
+    softmax,
+)
+from ece496b_basics.nn_utils import clip_gradients, cross_entropy
+from ece496b_basics.optimizer import AdamW
+from ece496b_basics.serialization import load_checkpoint, save_checkpoint
+from ece496b_basics.tokenizer import Tokenizer
+from ece496b_basics.train_bpe import train_bpe
+
 
 def run_positionwise_feedforward(
     d_model: int,
@@ -37,13 +54,9 @@ def run_positionwise_feedforward(
         torch.FloatTensor with the output of running your position-wise feedforward network
         with the provided `weights` on the provided `in_features`.
     """
-    # Example:
-    # If your state dict keys match, you can use `load_state_dict()`
-    # my_ffn.load_state_dict(weights)
-    # You can also manually assign the weights
-    # my_ffn.w1.weight.data = weights["w1.weight"]
-    # my_ffn.w2.weight.data = weights["w2.weight"]
-    raise NotImplementedError
+    ffn = PositionwiseFeedForward(d_model, d_ff)
+    ffn.load_state_dict(weights)
+    return ffn(in_features)
 
 
 def run_scaled_dot_product_attention(
@@ -52,6 +65,7 @@ def run_scaled_dot_product_attention(
     V: torch.FloatTensor,
     mask: Optional[torch.BoolTensor] = None,
     pdrop: Optional[float] = None,
+    **kwargs,
 ) -> torch.FloatTensor:
     """Given key (K), query (Q), and value (V) tensors, return
     the output of your scaled dot product attention implementation.
@@ -80,12 +94,20 @@ def run_scaled_dot_product_attention(
             If given, drop-out the attention probabilities (the softmax-normalized
             attention scores) with this rate.
 
+    Keyword Args:
+        block_size: Optional[int]
+            If given, compute the attention in tiles of this many queries and keys
+            with an online softmax, without materializing the full score matrix.
+        causal: bool, default is False
+            Also mask out later keys, with the queries aligned to the last keys.
+            With `block_size`, the tiles above the diagonal are skipped.
+
     Returns:
         torch.FloatTensor of shape (batch_size, ..., seq_len, value_dimension)
         with the output of running your scaled dot product attention
         implementation with the provided key, query, and value tensors.
     """
-    raise NotImplementedError
+    return scaled_dot_product_attention(K, Q, V, mask=mask, pdrop=pdrop, **kwargs)
 
 
 def run_multihead_self_attention(
@@ -94,6 +116,7 @@ def run_multihead_self_attention(
     attn_pdrop: float,
     weights: dict[str, torch.FloatTensor],
     in_features: torch.FloatTensor,
+    **kwargs,
 ) -> torch.FloatTensor:
     """Given the key, query, and value projection weights of a naive unbatched
     implementation of multi-head attention, return the output of an optimized batched
@@ -134,8 +157,21 @@ def run_multihead_self_attention(
     Returns:
         torch.FloatTensor with the output of running your optimized, batched multi-headed attention
         implementation with the given QKV projection weights and input features.
+
+    Keyword Args:
+        segment_ids: torch.LongTensor, optional
+            Document ids of shape (batch_size, seq_len) for packed sequences
+            (see `ece496b_basics.data.get_packed_batch`). Attention becomes
+            block-diagonal causal: tokens only attend within their own document.
     """
-    raise NotImplementedError
+    attn = MultiHeadSelfAttention(d_model, num_heads, attn_pdrop)
+    state_dict = {"output_proj.weight": weights["output_proj.weight"]}
+    for name in ["q", "k", "v"]:
+        state_dict[f"{name}_proj.weight"] = torch.cat(
+            [weights[f"{name}_heads.{head}.weight"] for head in range(num_heads)]
+        )
+    attn.load_state_dict(state_dict)
+    return attn(in_features, **kwargs)
 
 
 def run_transformer_block(
@@ -207,7 +243,9 @@ def run_transformer_block(
         FloatTensor of shape (batch_size, sequence_length, d_model) with the output of
         running the Transformer block on the input features.
     """
-    raise NotImplementedError
+    block = TransformerBlock(d_model, num_heads, d_ff, attn_pdrop, residual_pdrop)
+    block.load_state_dict(weights)
+    return block(in_features)
 
 
 def run_transformer_lm(
@@ -300,7 +338,18 @@ def run_transformer_lm(
         FloatTensor of shape (batch size, sequence_length, vocab_size) with the predicted unnormalized
         next-word distribution for each token.
     """
-    raise NotImplementedError
+    model = TransformerLM(
+        vocab_size,
+        context_length,
+        d_model,
+        num_layers,
+        num_heads,
+        d_ff,
+        attn_pdrop,
+        residual_pdrop,
+    )
+    model.load_state_dict(weights)
+    return model(in_indices)
 
 
 def run_rmsnorm(
@@ -331,7 +380,9 @@ def run_rmsnorm(
         FloatTensor of with the same shape as `in_features` with the output of running
         RMSNorm of the `in_features`.
     """
-    raise NotImplementedError
+    rmsnorm = RMSNorm(d_model, eps)
+    rmsnorm.load_state_dict(weights)
+    return rmsnorm(in_features)
 
 
 def run_gelu(in_features: torch.FloatTensor) -> torch.FloatTensor:
@@ -346,11 +397,11 @@ def run_gelu(in_features: torch.FloatTensor) -> torch.FloatTensor:
         FloatTensor of with the same shape as `in_features` with the output of applying
         GELU to each element.
     """
-    raise NotImplementedError
+    return gelu(in_features)
 
 
 def run_get_batch(
-    dataset: npt.NDArray, batch_size: int, context_length: int, device: str
+    dataset: npt.NDArray, batch_size: int, context_length: int, device: str, **kwargs
 ) -> tuple[torch.Tensor, torch.Tensor]:
     """
     Given a dataset (a 1D numpy array of integers) and a desired batch size and
@@ -372,8 +423,13 @@ def run_get_batch(
         Tuple of torch.LongTensors of shape (batch_size, context_length). The first tuple item
         is the sampled input sequences, and the second tuple item is the corresponding
         language modeling labels.
+
+    Keyword Args:
+        sampler: ece496b_basics.data.EpochSampler, optional
+            Take the next windows of this deterministic, resumable sampler instead of
+            drawing start indices uniformly at random.
     """
-    raise NotImplementedError
+    return get_batch(dataset, batch_size, context_length, device, **kwargs)
 
 
 def run_softmax(in_features: torch.FloatTensor, dim: int) -> torch.FloatTensor:
@@ -390,7 +446,7 @@ def run_softmax(in_features: torch.FloatTensor, dim: int) -> torch.FloatTensor:
         FloatTensor of with the same shape as `in_features` with the output of
         softmax normalizing the specified `dim`.
     """
-    raise NotImplementedError
+    return softmax(in_features, dim)
 
 
 def run_cross_entropy(inputs: torch.FloatTensor, targets: torch.LongTensor):
@@ -408,7 +464,7 @@ def run_cross_entropy(inputs: torch.FloatTensor, targets: torch.LongTensor):
     Returns:
         Tensor of shape () with the average cross-entropy loss across examples.
     """
-    raise NotImplementedError
+    return cross_entropy(inputs, targets)
 
 
 def run_gradient_clipping(parameters: Iterable[torch.nn.Parameter], max_l2_norm: float):
@@ -423,14 +479,14 @@ def run_gradient_clipping(parameters: Iterable[torch.nn.Parameter], max_l2_norm:
     Returns:
         None
     """
-    raise NotImplementedError
+    clip_gradients(parameters, max_l2_norm)
 
 
 def get_adamw_cls() -> Type[torch.optim.Optimizer]:
     """
     Returns a torch.optim.Optimizer that implements AdamW.
     """
-    raise NotImplementedError
+    return AdamW
 
 
 def run_get_lr_cosine_schedule(
@@ -471,6 +527,7 @@ def run_save_checkpoint(
     optimizer: torch.optim.Optimizer,
     iteration: int,
     out: str | os.PathLike | BinaryIO | IO[bytes],
+    **kwargs,
 ):
     """
     Given a model, optimizer, and an iteration number, serialize them to disk.
@@ -485,14 +542,19 @@ def run_save_checkpoint(
             we've completed.
         out: str | os.PathLike | BinaryIO | IO[bytes]
             Path or file-like object to serialize the model, optimizer, and iteration to.
+
+    Keyword Args:
+        sampler: ece496b_basics.data.EpochSampler, optional
+            Also serialize the position of this data sampler.
     """
-    raise NotImplementedError
+    return save_checkpoint(model, optimizer, iteration, out, **kwargs)
 
 
 def run_load_checkpoint(
     src: str | os.PathLike | BinaryIO | IO[bytes],
     model: torch.nn.Module,
     optimizer: torch.optim.Optimizer,
+    **kwargs,
 ):
     """
     Given a serialized checkpoint (path or file-like object), restore the
@@ -509,8 +571,12 @@ def run_load_checkpoint(
             Restore the state of this optimizer.
     Returns:
         int, the previously-serialized number of iterations.
+
+    Keyword Args:
+        sampler: ece496b_basics.data.EpochSampler, optional
+            Restore the data sampler position saved with the checkpoint.
     """
-    raise NotImplementedError
+    return load_checkpoint(src, model, optimizer, **kwargs)
 
 
 def get_tokenizer(
@@ -536,7 +602,7 @@ def get_tokenizer(
     Returns:
         A BPE tokenizer that uses the provided vocab, merges, and special tokens.
     """
-    raise NotImplementedError
+    return Tokenizer(vocab, merges, special_tokens)
 
 
 def run_train_bpe(
@@ -568,5 +634,26 @@ def run_train_bpe(
                 BPE merges. Each list item is a tuple of bytes (<token1>, <token2>),
                 representing that <token1> was merged with <token2>.
                 Merges are ordered by order of creation.
+
+    Keyword Args:
+        num_workers: int, default is `os.cpu_count()`
+            Number of processes used to pre-tokenize the corpus. The corpus is split
+            into chunks at special-token boundaries, so the result does not depend
+            on the number of workers.
+        compact: bool, default is False
+            Store pre-tokens as int32 token ids in one flat buffer (see
+            `ece496b_basics.train_bpe.FlatWords`) to reduce peak memory.
+        checkpoint_path: str | os.PathLike, optional
+            Snapshot the training state here every `checkpoint_every` merges
+            (default 1000) and at the end of training.
+        resume_from: str | os.PathLike, optional
+            Continue training from a snapshot written via `checkpoint_path`.
+        pretoken_cache_dir: str | os.PathLike, optional
+            Directory for caching pre-token counts across runs on the same corpus,
+            bounded by `pretoken_cache_max_bytes` (default 4 GiB).
+        timings: dict[str, float], optional
+            Filled with the seconds spent in each training phase.
+        merge_latencies: list[float], optional
+            The seconds taken by every merge are appended to it.
     """
-    raise NotImplementedError
+    return train_bpe(input_path, vocab_size, special_tokens, **kwargs)
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""CPU latency and peak memory of scaled dot-product attention, materializing the
+full score matrix versus tiling it with an online softmax, across sequence lengths.
+
+Run from the repository root, e.g.
+
+    python -m tests.benchmark_attention --seq-lens 512,1024,2048,4096 --block-size 128
+
+Every (mode, sequence length) pair runs causal attention on random inputs of shape
+(batch_size, num_heads, seq_len, d_head) in a forked child process, so that the
+peak RSS it reports is the growth caused by that attention call alone. The full
+mode applies a boolean causal mask; the tiled mode is structurally causal and skips
+the tiles above the diagonal. With
+`--backward`, the time and memory of the backward pass are included.
+
+With `--projections`, the forward pass of one `MultiHeadSelfAttention` layer with its
+fused QKV projection is also timed against three separate query, key and value
+projections with the same weights, and the per-layer speedup is reported.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import time
+from typing import Optional
+
+import psutil
+import torch
+import torch.nn.functional as F
+
+from ece496b_basics.memory import peak_rss_mb
+from ece496b_basics.model import (
+    MultiHeadSelfAttention,
+    causal_mask,
+    scaled_dot_product_attention,
+)
+
+from .common import benchmark_metadata, run_in_forked_process
+
+logger = logging.getLogger(__name__)
+
+
+def _run(args: argparse.Namespace, seq_len: int, block_size: Optional[int]) -> dict:
+    torch.manual_seed(0)
+    shape = (args.batch_size, args.num_heads, seq_len, args.d_head)
+    K, Q, V = (torch.randn(shape, requires_grad=args.backward) for _ in range(3))
+    mask = causal_mask(seq_len) if block_size is None else None
+
+    def step():
+        out = scaled_dot_product_attention(
+            K, Q, V, mask=mask, block_size=block_size, causal=mask is None
+        )
+        if args.backward:
+            out.sum().backward()
+        return out
+
+    with torch.set_grad_enabled(args.backward):
+        step()  # Warm up.
+        baseline_mb = psutil.Process().memory_info().rss / 2**20
+        times = []
+        for _ in range(args.repeats):
+            start = time.perf_counter()
+            step()
+            times.append(time.perf_counter() - start)
+    peak_mb = peak_rss_mb()
+    return {
+        "seq_len": seq_len,
+        "mode": "full" if block_size is None else "tiled",
+        "block_size": block_size,
+        "best_s": min(times),
+        "mean_s": sum(times) / len(times),
+        "peak_rss_growth_mb": peak_mb - baseline_mb,
+        # Size of one (batch_size, num_heads, seq_len, seq_len) float32 score matrix.
+        "score_matrix_mb": args.batch_size * args.num_heads * seq_len**2 * 4 / 2**20,
+    }
+
+
+def benchmark(args: argparse.Namespace, seq_len: int, block_size: Optional[int]):
+    record = run_in_forked_process(_run, args, seq_len, block_size)
+    logger.info(
+        "seq_len %5d, %5s: %8.2f ms, peak RSS growth %8.1f MB",
+        seq_len,
+        record["mode"],
+        1e3 * record["best_s"],
+        record["peak_rss_growth_mb"],
+    )
+    return record
+
+
+def separate_projections_attention(
+    attn: MultiHeadSelfAttention, x: torch.Tensor
+) -> torch.Tensor:
+    """`attn(x)` with one matrix multiply and head reshape per projection."""
+    mask = causal_mask(x.shape[-2], x.device)
+    q, k, v = (
+        F.linear(x, weight).unflatten(-1, (attn.num_heads, attn.d_head)).transpose(1, 2)
+        for weight in attn.qkv_proj.weight.chunk(3)
+    )
+    out = scaled_dot_product_attention(k, q, v, mask=mask)
+    return attn.output_proj(out.transpose(1, 2).flatten(-2))
+
+
+def _best_time(fn, repeats: int) -> float:
+    fn()  # Warm up.
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+@torch.no_grad()
+def benchmark_projections(args: argparse.Namespace, seq_len: int) -> dict:
+    torch.manual_seed(0)
+    d_model = args.num_heads * args.d_head
+    attn = MultiHeadSelfAttention(d_model, args.num_heads).eval()
+    x = torch.randn(args.batch_size, seq_len, d_model)
+    if not torch.allclose(attn(x), separate_projections_attention(attn, x), atol=1e-5):
+        logger.warning("seq_len %d: fused and separate projections differ", seq_len)
+    fused_s = _best_time(lambda: attn(x), args.repeats)
+    separate_s = _best_time(
+        lambda: separate_projections_attention(attn, x), args.repeats
+    )
+    record = {
+        "seq_len": seq_len,
+        "mode": "layer",
+        "d_model": d_model,
+        "fused_qkv_s": fused_s,
+        "separate_qkv_s": separate_s,
+        "speedup": separate_s / fused_s,
+    }
+    logger.info(
+        "seq_len %5d, layer: %8.2f ms fused QKV, %8.2f ms separate (%.2fx)",
+        seq_len,
+        1e3 * fused_s,
+        1e3 * separate_s,
+        record["speedup"],
+    )
+    return record
+
+
+def main(argv: Optional[list[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--output", default="attention_bench.json")
+    parser.add_argument("--seq-lens", default="256,512,1024,2048")
+    parser.add_argument("--block-size", type=int, default=128)
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--num-heads", type=int, default=16)
+    parser.add_argument("--d-head", type=int, default=64)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--num-threads", type=int, default=None)
+    parser.add_argument(
+        "--backward", action="store_true", help="Also time the backward pass."
+    )
+    parser.add_argument(
+        "--projections",
+        action="store_true",
+        help="Also time a fused QKV attention layer against separate projections.",
+    )
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    results = []
+    for seq_len in args.seq_lens.split(","):
+        for block_size in (None, args.block_size):
+            results.append(benchmark(args, int(seq_len), block_size))
+        if args.projections:
+            results.append(benchmark_projections(args, int(seq_len)))
+    report = {**benchmark_metadata(), "args": vars(args), "results": results}
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    logger.info("Wrote %d results to %s", len(results), args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""Peak memory versus step time of TransformerLM training steps on CPU, as more
+blocks run with activation checkpointing.
+
+Run from the repository root, e.g.
+
+    python -m tests.benchmark_checkpointing --num-layers 8 --context-length 1024
+
+For every number k of checkpointed layers in `--num-checkpointed` (default: 0 to
+`--num-layers`), the first k blocks of a randomly initialized model are
+checkpointed and forward plus backward passes on random batches are timed in a
+forked child process, whose peak RSS growth is the memory the step needs beyond
+the model and its gradients. Each result is a point of the memory/step-time curve.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import time
+from typing import Optional
+
+import psutil
+import torch
+import torch.nn.functional as F
+
+from ece496b_basics.memory import peak_rss_mb
+from ece496b_basics.model import TransformerLM
+
+from .common import benchmark_metadata, run_in_forked_process
+
+logger = logging.getLogger(__name__)
+
+
+def _train_steps(args: argparse.Namespace, num_checkpointed: int) -> dict:
+    torch.manual_seed(0)
+    model = TransformerLM(
+        vocab_size=args.vocab_size,
+        context_length=args.context_length,
+        d_model=args.d_model,
+        num_layers=args.num_layers,
+        num_heads=args.num_heads,
+        d_ff=4 * args.d_model,
+        attn_block_size=args.attn_block_size,
+        checkpoint_layers=range(num_checkpointed),
+    )
+    shape = (args.batch_size, args.context_length)
+    x, y = torch.randint(0, args.vocab_size, (2, *shape))
+
+    def step():
+        logits = model(x)
+        loss = F.cross_entropy(logits.flatten(0, 1), y.flatten())
+        loss.backward()
+
+    step()  # Warm up, and allocate the gradients.
+    baseline_mb = psutil.Process().memory_info().rss / 2**20
+    times = []
+    for _ in range(args.steps):
+        start = time.perf_counter()
+        step()
+        times.append(time.perf_counter() - start)
+    return {
+        "num_checkpointed": num_checkpointed,
+        "best_step_s": min(times),
+        "mean_step_s": sum(times) / len(times),
+        "tokens_per_s": args.batch_size * args.context_length / min(times),
+        "peak_rss_growth_mb": peak_rss_mb() - baseline_mb,
+    }
+
+
+def main(argv: Optional[list[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--output", default="checkpointing_bench.json")
+    parser.add_argument(
+        "--num-checkpointed",
+        default=None,
+        help="Comma-separated numbers of checkpointed layers (default: all).",
+    )
+    parser.add_argument("--vocab-size", type=int, default=1000)
+    parser.add_argument("--context-length", type=int, default=512)
+    parser.add_argument("--d-model", type=int, default=256)
+    parser.add_argument("--num-layers", type=int, default=4)
+    parser.add_argument("--num-heads", type=int, default=8)
+    parser.add_argument("--attn-block-size", type=int, default=None)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--steps", type=int, default=2)
+    parser.add_argument("--num-threads", type=int, default=None)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    if args.num_checkpointed is None:
+        counts = range(args.num_layers + 1)
+    else:
+        counts = [int(count) for count in args.num_checkpointed.split(",")]
+    results = []
+    for num_checkpointed in counts:
+        record = run_in_forked_process(_train_steps, args, num_checkpointed)
+        logger.info(
+            "%2d checkpointed layers: %8.3f s/step, peak RSS growth %8.1f MB",
+            num_checkpointed,
+            record["best_step_s"],
+            record["peak_rss_growth_mb"],
+        )
+        results.append(record)
+    report = {**benchmark_metadata(), "args": vars(args), "results": results}
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    logger.info("Wrote %d results to %s", len(results), args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""CPU generation throughput of `TransformerLM.generate` with KV caching, against
+recomputing the forward pass over the whole prefix for every token.
+
+Run from the repository root, e.g.
+
+    python -m tests.benchmark_generation --context-lengths 128,256,512,1024
+
+For every context length a randomly initialized model is built, a prompt of a
+quarter of the context is fed in, and tokens are decoded greedily until the context
+is full. Tokens/s of both modes are written to a JSON file.
+
+With `--batch-sizes`, `TransformerLM.generate_batch` is also timed on batches of
+prompts of random lengths, and the aggregate tokens/s of every batch size is
+reported.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import time
+from typing import Optional
+
+import torch
+
+from ece496b_basics.memory import peak_rss_mb
+from ece496b_basics.model import TransformerLM
+
+from .common import benchmark_metadata
+
+logger = logging.getLogger(__name__)
+
+
+@torch.no_grad()
+def generate_without_cache(
+    model: TransformerLM, prompt_ids: torch.Tensor, max_new_tokens: int
+) -> torch.Tensor:
+    """Greedy decoding that runs the full forward pass for every new token."""
+    sequence = prompt_ids
+    for _ in range(max_new_tokens):
+        next_id = model(sequence[None])[0, -1].argmax()
+        sequence = torch.cat([sequence, next_id[None]])
+    return sequence[len(prompt_ids) :]
+
+
+def benchmark_context_length(args: argparse.Namespace, context_length: int) -> dict:
+    model = _build_model(args, context_length)
+    prompt_length = context_length // 4
+    max_new_tokens = context_length - prompt_length
+    prompt = torch.randint(0, args.vocab_size, (prompt_length,))
+
+    start = time.perf_counter()
+    cached = model.generate(prompt, max_new_tokens, temperature=0.0)
+    cached_seconds = time.perf_counter() - start
+    record = {
+        "context_length": context_length,
+        "prompt_length": prompt_length,
+        "new_tokens": len(cached),
+        "kv_cache_tokens_per_s": len(cached) / cached_seconds,
+    }
+    if not args.skip_recompute:
+        start = time.perf_counter()
+        recomputed = generate_without_cache(model, prompt, len(cached))
+        recompute_seconds = time.perf_counter() - start
+        record["recompute_tokens_per_s"] = len(recomputed) / recompute_seconds
+        record["speedup"] = recompute_seconds / cached_seconds
+        if not torch.equal(cached, recomputed):
+            logger.warning(
+                "Context %d: cached and recomputed tokens differ", context_length
+            )
+    record["peak_rss_mb"] = peak_rss_mb()
+    logger.info(
+        "context %5d: %8.1f tokens/s with KV cache, %8.1f tokens/s recomputing",
+        context_length,
+        record["kv_cache_tokens_per_s"],
+        record.get("recompute_tokens_per_s", float("nan")),
+    )
+    return record
+
+
+def _build_model(args: argparse.Namespace, context_length: int) -> TransformerLM:
+    torch.manual_seed(0)
+    return TransformerLM(
+        vocab_size=args.vocab_size,
+        context_length=context_length,
+        d_model=args.d_model,
+        num_layers=args.num_layers,
+        num_heads=args.num_heads,
+        d_ff=4 * args.d_model,
+    ).eval()
+
+
+def benchmark_batch_size(
+    args: argparse.Namespace, model: TransformerLM, batch_size: int
+) -> dict:
+    context_length = model.context_length
+    prompts = [
+        torch.randint(0, args.vocab_size, (length,))
+        for length in torch.randint(
+            context_length // 8, context_length // 4 + 1, (batch_size,)
+        ).tolist()
+    ]
+    start = time.perf_counter()
+    generated = model.generate_batch(
+        prompts, context_length // 2, temperature=0.0, eos_id=args.eos_id
+    )
+    seconds = time.perf_counter() - start
+    new_tokens = sum(len(ids) for ids in generated)
+    record = {
+        "context_length": context_length,
+        "batch_size": batch_size,
+        "new_tokens": new_tokens,
+        "tokens_per_s": new_tokens / seconds,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    logger.info("batch size %3d: %8.1f tokens/s", batch_size, record["tokens_per_s"])
+    return record
+
+
+def main(argv: Optional[list[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--output", default="generation_bench.json")
+    parser.add_argument("--context-lengths", default="128,256,512")
+    parser.add_argument("--vocab-size", type=int, default=10000)
+    parser.add_argument("--d-model", type=int, default=512)
+    parser.add_argument("--num-layers", type=int, default=4)
+    parser.add_argument("--num-heads", type=int, default=16)
+    parser.add_argument("--num-threads", type=int, default=None)
+    parser.add_argument(
+        "--batch-sizes",
+        default="",
+        help="Comma-separated batch sizes for batched generation, e.g. 1,4,16.",
+    )
+    parser.add_argument("--batch-context-length", type=int, default=256)
+    parser.add_argument(
+        "--eos-id", type=int, default=None, help="Stop rows at this token id."
+    )
+    parser.add_argument(
+        "--skip-recompute",
+        action="store_true",
+        help="Only time generation with the KV cache.",
+    )
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    results = [
+        benchmark_context_length(args, int(context_length))
+        for context_length in args.context_lengths.split(",")
+    ]
+    if args.batch_sizes:
+        model = _build_model(args, args.batch_context_length)
+        results.extend(
+            benchmark_batch_size(args, model, int(batch_size))
+            for batch_size in args.batch_sizes.split(",")
+        )
+    report = {**benchmark_metadata(), "args": vars(args), "results": results}
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    logger.info("Wrote %d results to %s", len(results), args.output)
+
+
+if __name__ == "__main__":
+    main()
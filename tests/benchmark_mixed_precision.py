@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""Loss-curve parity, throughput and memory of bfloat16 mixed-precision training of
+`TransformerLM` on CPU, against float32.
+
+Run from the repository root, e.g.
+
+    python -m tests.benchmark_mixed_precision --dataset tinystories_train.npy \\
+        --vocab-size 10000 --steps 200
+
+`--dataset` is a token file readable by `ece496b_basics.data.TokenDataset`, such as
+TinyStories encoded with `Tokenizer.encode_file`. Without it, the UTF-8 bytes of
+the TinyStories sample fixture are used as tokens (vocab size 256), which is enough
+for a short parity check.
+
+Both runs start from the same initialization and see the same batches; each runs
+in a forked child process, so that its peak RSS growth covers only its own
+training. The per-step losses of both runs, their largest difference, the training
+tokens/s and the peak RSS growth are written to a JSON file.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import time
+from typing import Optional
+
+import numpy as np
+import psutil
+import torch
+
+from ece496b_basics.data import TokenDataset, get_batch
+from ece496b_basics.memory import peak_rss_mb
+from ece496b_basics.model import TransformerLM
+from ece496b_basics.nn_utils import clip_gradients, cross_entropy
+from ece496b_basics.optimizer import AdamW
+
+from .common import (
+    FIXTURES_PATH,
+    benchmark_metadata,
+    run_in_forked_process,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def _load_tokens(args: argparse.Namespace) -> np.ndarray:
+    if args.dataset is not None:
+        return TokenDataset(args.dataset).tokens
+    with open(FIXTURES_PATH / "tinystories_sample.txt", "rb") as f:
+        return np.frombuffer(f.read(), dtype=np.uint8)
+
+
+def _train(args: argparse.Namespace, autocast_dtype: Optional[torch.dtype]) -> dict:
+    tokens = _load_tokens(args)
+    torch.manual_seed(0)
+    model = TransformerLM(
+        vocab_size=args.vocab_size,
+        context_length=args.context_length,
+        d_model=args.d_model,
+        num_layers=args.num_layers,
+        num_heads=args.num_heads,
+        d_ff=4 * args.d_model,
+        attn_block_size=args.attn_block_size,
+        autocast_dtype=autocast_dtype,
+    )
+    optimizer = AdamW(model.parameters(), lr=args.lr)
+    rng = np.random.default_rng(0)
+    baseline_mb = psutil.Process().memory_info().rss / 2**20
+
+    losses = []
+    start = time.perf_counter()
+    for _ in range(args.steps):
+        x, y = get_batch(tokens, args.batch_size, args.context_length, "cpu", rng=rng)
+        loss = cross_entropy(model(x).flatten(0, 1), y.flatten())
+        optimizer.zero_grad(set_to_none=True)
+        loss.backward()
+        clip_gradients(model.parameters(), args.max_grad_norm)
+        optimizer.step()
+        losses.append(loss.item())
+    seconds = time.perf_counter() - start
+    return {
+        "dtype": str(autocast_dtype or torch.float32).removeprefix("torch."),
+        "losses": losses,
+        "tokens_per_s": args.steps * args.batch_size * args.context_length / seconds,
+        "peak_rss_growth_mb": peak_rss_mb() - baseline_mb,
+    }
+
+
+def main(argv: Optional[list[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--output", default="mixed_precision_bench.json")
+    parser.add_argument("--dataset", default=None, help="Token file to train on.")
+    parser.add_argument("--vocab-size", type=int, default=256)
+    parser.add_argument("--context-length", type=int, default=128)
+    parser.add_argument("--d-model", type=int, default=256)
+    parser.add_argument("--num-layers", type=int, default=4)
+    parser.add_argument("--num-heads", type=int, default=8)
+    parser.add_argument("--attn-block-size", type=int, default=None)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--steps", type=int, default=50)
+    parser.add_argument("--lr", type=float, default=1e-3)
+    parser.add_argument("--max-grad-norm", type=float, default=1.0)
+    parser.add_argument("--num-threads", type=int, default=None)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    results = [
+        run_in_forked_process(_train, args, autocast_dtype)
+        for autocast_dtype in (None, torch.bfloat16)
+    ]
+    for record in results:
+        logger.info(
+            "%8s: final loss %.4f, %8.1f tokens/s, peak RSS growth %8.1f MB",
+            record["dtype"],
+            record["losses"][-1],
+            record["tokens_per_s"],
+            record["peak_rss_growth_mb"],
+        )
+    fp32_losses, bf16_losses = (np.array(record["losses"]) for record in results)
+    parity = {
+        "max_abs_loss_diff": float(np.abs(bf16_losses - fp32_losses).max()),
+        "final_loss_diff": float(bf16_losses[-1] - fp32_losses[-1]),
+        "speedup": results[1]["tokens_per_s"] / results[0]["tokens_per_s"],
+    }
+    logger.info(
+        "bfloat16 vs float32: max loss difference %.4f, final %.4f, %.2fx tokens/s",
+        parity["max_abs_loss_diff"],
+        parity["final_loss_diff"],
+        parity["speedup"],
+    )
+    report = {
+        **benchmark_metadata(),
+        "args": vars(args),
+        "parity": parity,
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    logger.info("Wrote %d results to %s", len(results), args.output)
+
+
+if __name__ == "__main__":
+    main()
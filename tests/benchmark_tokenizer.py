@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+"""Throughput benchmark of the `get_tokenizer` tokenizer against tiktoken's GPT-2.
+
+Run from the repository root, e.g.
+
+    python -m tests.benchmark_tokenizer --output tokenizer_bench.json
+
+For every corpus (the text fixtures plus a synthetic corpus of `--synthetic-mb`
+megabytes), this times `encode`, `encode_iterable`, `decode` and batch encoding of
+both tokenizers and reports MB/s and tokens/s (best of `--repeats` runs), and the
+peak RSS of the process after each corpus. Results are written as JSON so they can
+be compared across commits.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import os
+import random
+import tempfile
+import time
+from typing import Callable, Optional
+
+import tiktoken
+
+from ece496b_basics.memory import peak_rss_mb
+
+from .common import FIXTURES_PATH, benchmark_metadata
+from .test_tokenizer import (
+    MERGES_PATH,
+    VOCAB_PATH,
+    get_tokenizer_from_vocab_merges_path,
+)
+
+logger = logging.getLogger(__name__)
+
+SPECIAL_TOKENS = ["<|endoftext|>"]
+FIXTURE_CORPORA = [
+    "tinystories_sample_5M.txt",
+    "german.txt",
+    "address.txt",
+    "corpus.en",
+]
+
+
+def make_synthetic_corpus(path: str | os.PathLike, num_bytes: int, seed: int = 0):
+    """Write roughly `num_bytes` of text to `path`, built by sampling lines of the
+    text fixtures, with an `<|endoftext|>` between every few lines."""
+    lines = []
+    for name in ["tinystories_sample.txt", "german.txt", "corpus.en"]:
+        with open(FIXTURES_PATH / name, encoding="utf-8") as f:
+            lines.extend(line for line in f if line.strip())
+    rng = random.Random(seed)
+    written = 0
+    with open(path, "w", encoding="utf-8") as f:
+        while written < num_bytes:
+            document = "".join(rng.choices(lines, k=rng.randint(1, 8)))
+            document += "<|endoftext|>"
+            f.write(document)
+            written += len(document.encode("utf-8"))
+
+
+def _documents(text: str) -> list[str]:
+    """Split a corpus into documents for batch encoding."""
+    if SPECIAL_TOKENS[0] in text:
+        return [document for document in text.split(SPECIAL_TOKENS[0]) if document]
+    return text.splitlines(keepends=True)
+
+
+def _best_time(
+    fn: Callable[[], object], repeats: int, setup=None
+) -> tuple[float, object]:
+    best = float("inf")
+    result = None
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def _record(
+    results: list[dict],
+    corpus: str,
+    tokenizer: str,
+    operation: str,
+    seconds: float,
+    num_bytes: int,
+    num_tokens: int,
+):
+    record = {
+        "corpus": corpus,
+        "tokenizer": tokenizer,
+        "operation": operation,
+        "seconds": seconds,
+        "num_bytes": num_bytes,
+        "num_tokens": num_tokens,
+        "mb_per_s": num_bytes / 1e6 / seconds if seconds else None,
+        "tokens_per_s": num_tokens / seconds if seconds else None,
+    }
+    results.append(record)
+    logger.info(
+        "%-28s %-8s %-16s %8.2f MB/s %12.0f tokens/s",
+        corpus,
+        tokenizer,
+        operation,
+        record["mb_per_s"] or 0.0,
+        record["tokens_per_s"] or 0.0,
+    )
+
+
+def benchmark_corpus(
+    path: str | os.PathLike,
+    tokenizer,
+    reference: Optional[tiktoken.Encoding],
+    repeats: int,
+    num_workers: Optional[int],
+) -> list[dict]:
+    name = os.path.basename(path)
+    with open(path, encoding="utf-8") as f:
+        text = f.read()
+    num_bytes = len(text.encode("utf-8"))
+    documents = _documents(text)
+    results: list[dict] = []
+
+    def read_lines():
+        with open(path, encoding="utf-8") as f:
+            return sum(1 for _ in tokenizer.encode_iterable(f))
+
+    seconds, ids = _best_time(
+        lambda: tokenizer.encode(text), repeats, setup=tokenizer.cache_clear
+    )
+    _record(results, name, "ours", "encode", seconds, num_bytes, len(ids))
+    seconds, num_tokens = _best_time(read_lines, repeats, setup=tokenizer.cache_clear)
+    _record(results, name, "ours", "encode_iterable", seconds, num_bytes, num_tokens)
+    seconds, _ = _best_time(lambda: tokenizer.decode(ids), repeats)
+    _record(results, name, "ours", "decode", seconds, num_bytes, len(ids))
+    seconds, batch = _best_time(
+        lambda: tokenizer.encode_batch(documents, num_workers=num_workers), repeats
+    )
+    num_tokens = sum(len(document_ids) for document_ids in batch)
+    _record(results, name, "ours", "encode_batch", seconds, num_bytes, num_tokens)
+
+    if reference is not None:
+        allowed_special = set(SPECIAL_TOKENS)
+        seconds, reference_ids = _best_time(
+            lambda: reference.encode(text, allowed_special=allowed_special), repeats
+        )
+        _record(
+            results, name, "tiktoken", "encode", seconds, num_bytes, len(reference_ids)
+        )
+        if reference_ids != ids:
+            logger.warning("%s: token ids differ from tiktoken", name)
+        seconds, _ = _best_time(lambda: reference.decode(reference_ids), repeats)
+        _record(
+            results, name, "tiktoken", "decode", seconds, num_bytes, len(reference_ids)
+        )
+        seconds, batch = _best_time(
+            lambda: reference.encode_batch(
+                documents, num_threads=num_workers or os.cpu_count() or 1
+            ),
+            repeats,
+        )
+        num_tokens = sum(len(document_ids) for document_ids in batch)
+        _record(
+            results, name, "tiktoken", "encode_batch", seconds, num_bytes, num_tokens
+        )
+
+    for record in results:
+        record["peak_rss_mb"] = peak_rss_mb()
+    return results
+
+
+def main(argv: Optional[list[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--output", default="tokenizer_bench.json")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--synthetic-mb", type=float, default=32.0)
+    parser.add_argument("--num-workers", type=int, default=None)
+    parser.add_argument(
+        "--corpus",
+        action="append",
+        default=[],
+        help="Additional corpus to benchmark. May be given several times.",
+    )
+    parser.add_argument(
+        "--no-tiktoken", action="store_true", help="Only benchmark our tokenizer."
+    )
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    tokenizer = get_tokenizer_from_vocab_merges_path(
+        VOCAB_PATH, MERGES_PATH, special_tokens=SPECIAL_TOKENS
+    )
+    # Build the lazily constructed lookup tables outside of the timed region.
+    tokenizer.encode("warm up")
+    reference = None if args.no_tiktoken else tiktoken.get_encoding("gpt2")
+
+    corpora = []
+    for name in FIXTURE_CORPORA:
+        if (FIXTURES_PATH / name).exists():
+            corpora.append(FIXTURES_PATH / name)
+        else:
+            logger.warning("Skipping missing fixture %s", name)
+    corpora.extend(args.corpus)
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if args.synthetic_mb > 0:
+            synthetic_path = os.path.join(tmp_dir, "synthetic.txt")
+            make_synthetic_corpus(synthetic_path, int(args.synthetic_mb * 1e6))
+            corpora.append(synthetic_path)
+        for path in corpora:
+            results.extend(
+                benchmark_corpus(
+                    path, tokenizer, reference, args.repeats, args.num_workers
+                )
+            )
+
+    report = {**benchmark_metadata(), "args": vars(args), "results": results}
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    logger.info("Wrote %d results to %s", len(results), args.output)
+
+
+if __name__ == "__main__":
+    main()
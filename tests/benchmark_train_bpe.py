@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+"""Per-phase timing of BPE training across corpus and vocab sizes.
+
+Run from the repository root, e.g.
+
+    python -m tests.benchmark_train_bpe --sizes-mb 1,4,16 --vocab-sizes 1000,5000
+
+Each corpus size is a synthetic corpus sampled from the text fixtures (see
+`tests.benchmark_tokenizer.make_synthetic_corpus`). For every corpus and vocab size,
+`run_train_bpe` runs in a forked child process and reports the time of each of its
+phases (input hashing, parallel pre-tokenization, initial pair counting, the merge
+loop and checkpointing) through its `timings` argument, the latency of every merge
+as a histogram, and its peak RSS growth. With `--compact`, training uses the
+compact word storage. Serial pre-tokenization is also broken down once per corpus
+into file read, special-token split, regex pre-tokenization and counting.
+
+With `--profile DIR`, every training run is also recorded with cProfile into `DIR`,
+and the top functions by cumulative time are logged; the phase timings then include
+the profiling overhead. For a sampling profile, run this module under
+`py-spy record -o profile.svg -- python -m ...` instead.
+"""
+
+from __future__ import annotations
+
+import argparse
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import tempfile
+import time
+from collections import Counter
+from typing import Optional
+
+import numpy as np
+import psutil
+import regex as re
+
+from ece496b_basics.memory import peak_rss_mb
+from ece496b_basics.pretokenization import PAT, special_tokens_pattern
+
+from .adapters import run_train_bpe
+from .benchmark_tokenizer import make_synthetic_corpus
+from .common import benchmark_metadata, run_in_forked_process
+
+logger = logging.getLogger(__name__)
+
+SPECIAL_TOKENS = ["<|endoftext|>"]
+# Upper edges of the per-merge latency histogram buckets, in seconds.
+LATENCY_BUCKETS = [1e-6 * 10 ** (k / 2) for k in range(13)] + [float("inf")]
+
+
+def _timed(timings: dict[str, float], phase: str, fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    timings[phase] = time.perf_counter() - start
+    return result
+
+
+def _latency_summary(latencies: np.ndarray) -> dict:
+    if len(latencies) == 0:
+        return {"num_merges": 0}
+    counts = np.histogram(latencies, bins=[0.0] + LATENCY_BUCKETS)[0]
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99]).tolist()
+    return {
+        "num_merges": len(latencies),
+        "mean_s": float(latencies.mean()),
+        "p50_s": p50,
+        "p90_s": p90,
+        "p99_s": p99,
+        "max_s": float(latencies.max()),
+        "histogram": [
+            {"le_s": edge if edge != float("inf") else None, "count": int(count)}
+            for edge, count in zip(LATENCY_BUCKETS, counts)
+        ],
+        # Mean latency of each tenth of the merges, to show how the cost per merge
+        # evolves as words get shorter and pair counts get smaller.
+        "decile_mean_s": [
+            float(part.mean()) for part in np.array_split(latencies, 10) if len(part)
+        ],
+    }
+
+
+def pretokenize_phases(
+    input_path: str | os.PathLike, timings: dict[str, float]
+) -> Counter[str]:
+    """Serial pre-tokenization, timing each step into `timings`."""
+
+    def read():
+        with open(input_path, "rb") as f:
+            return f.read().decode("utf-8", errors="ignore")
+
+    text = _timed(timings, "file_read", read)
+    special_re = special_tokens_pattern(SPECIAL_TOKENS)
+    segments = _timed(timings, "special_token_split", special_re.split, text)
+    pattern = re.compile(PAT)
+    pretokens = _timed(
+        timings,
+        "regex_pretokenization",
+        lambda: [pattern.findall(segment) for segment in segments],
+    )
+
+    def count():
+        counts: Counter[str] = Counter()
+        for segment_pretokens in pretokens:
+            counts.update(segment_pretokens)
+        return counts
+
+    return _timed(timings, "counting", count)
+
+
+def _train(args: argparse.Namespace, input_path: str, vocab_size: int) -> dict:
+    baseline_mb = psutil.Process().memory_info().rss / 2**20
+    timings: dict[str, float] = {}
+    latencies: list[float] = []
+    kwargs = dict(
+        num_workers=args.num_workers,
+        compact=args.compact,
+        timings=timings,
+        merge_latencies=latencies,
+    )
+    profiler = None
+    if args.profile is not None:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    start = time.perf_counter()
+    run_train_bpe(input_path, vocab_size, SPECIAL_TOKENS, **kwargs)
+    seconds = time.perf_counter() - start
+    if profiler is not None:
+        profiler.disable()
+        profile_path = os.path.join(
+            args.profile,
+            f"train_bpe_{os.path.getsize(input_path)}B_{vocab_size}.prof",
+        )
+        profiler.dump_stats(profile_path)
+        summary = io.StringIO()
+        pstats.Stats(profiler, stream=summary).sort_stats("cumulative").print_stats(20)
+        logger.info("cProfile of %s:\n%s", profile_path, summary.getvalue())
+    return {
+        "phases_s": timings,
+        "total_s": seconds,
+        "merge_latency": _latency_summary(np.array(latencies)),
+        "peak_rss_growth_mb": peak_rss_mb() - baseline_mb,
+    }
+
+
+def benchmark_size(
+    args: argparse.Namespace, input_path: str, vocab_sizes: list[int]
+) -> list[dict]:
+    num_bytes = os.path.getsize(input_path)
+    pretokenize_timings: dict[str, float] = {}
+    num_unique_pretokens = len(pretokenize_phases(input_path, pretokenize_timings))
+    results = []
+    for vocab_size in vocab_sizes:
+        record = {
+            "num_bytes": num_bytes,
+            "vocab_size": vocab_size,
+            "compact": args.compact,
+            "num_unique_pretokens": num_unique_pretokens,
+            "serial_pretokenization_s": pretokenize_timings,
+            **run_in_forked_process(_train, args, input_path, vocab_size),
+        }
+        results.append(record)
+        logger.info(
+            "%10d bytes, vocab %6d: %s | total %.3fs, peak RSS growth %.1f MB",
+            num_bytes,
+            vocab_size,
+            ", ".join(
+                f"{phase} {seconds:.3f}s"
+                for phase, seconds in record["phases_s"].items()
+            ),
+            record["total_s"],
+            record["peak_rss_growth_mb"],
+        )
+    return results
+
+
+def _parse_list(value: str, type_) -> list:
+    return [type_(item) for item in value.split(",") if item]
+
+
+def main(argv: Optional[list[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--output", default="train_bpe_bench.json")
+    parser.add_argument(
+        "--sizes-mb", default="0.5,2,8", help="Comma-separated corpus sizes in MB."
+    )
+    parser.add_argument(
+        "--vocab-sizes", default="500,1000,5000", help="Comma-separated vocab sizes."
+    )
+    parser.add_argument(
+        "--corpus",
+        action="append",
+        default=[],
+        help="Additional corpus to benchmark. May be given several times.",
+    )
+    parser.add_argument("--num-workers", type=int, default=None)
+    parser.add_argument(
+        "--compact", action="store_true", help="Train with compact word storage."
+    )
+    parser.add_argument(
+        "--profile", metavar="DIR", default=None, help="Write cProfile output to DIR."
+    )
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    vocab_sizes = _parse_list(args.vocab_sizes, int)
+    if args.profile is not None:
+        os.makedirs(args.profile, exist_ok=True)
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        corpora = list(args.corpus)
+        for size_mb in _parse_list(args.sizes_mb, float):
+            path = os.path.join(tmp_dir, f"synthetic_{size_mb}MB.txt")
+            make_synthetic_corpus(path, int(size_mb * 1e6))
+            corpora.append(path)
+        for path in corpora:
+            results.extend(benchmark_size(args, path, vocab_sizes))
+
+    report = {**benchmark_metadata(), "args": vars(args), "results": results}
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    logger.info("Wrote %d results to %s", len(results), args.output)
+
+
+if __name__ == "__main__":
+    main()
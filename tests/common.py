@@ -1,8 +1,16 @@
 #!/usr/bin/env python3
 from __future__ import annotations
 
+import datetime
+import multiprocessing
+import os
 import pathlib
+import platform
+import subprocess
+import sys
+import traceback
 from functools import lru_cache
+from queue import Empty
 
 FIXTURES_PATH = (pathlib.Path(__file__).resolve().parent) / "fixtures"
 
@@ -57,3 +65,71 @@ def gpt2_bytes_to_unicode() -> dict[int, str]:
     characters = [chr(n) for n in cs]
     d = dict(zip(bs, characters))
     return d
+
+
+def run_in_forked_process(fn, *args):
+    """Return `fn(*args)` computed in a forked child process, so that the peak RSS
+    it measures is not inflated by earlier work of this process.
+
+    Raises:
+        RuntimeError: if `fn` raises in the child (the message holds the child's
+            traceback) or the child dies without returning a result.
+    """
+    context = multiprocessing.get_context("fork")
+    queue = context.Queue()
+
+    def target():
+        try:
+            queue.put((True, fn(*args)))
+        except BaseException:
+            queue.put((False, traceback.format_exc()))
+
+    process = context.Process(target=target)
+    process.start()
+    while True:
+        try:
+            ok, result = queue.get(timeout=1.0)
+            break
+        except Empty:
+            if process.is_alive():
+                continue
+            # The child may have put its result just before exiting.
+            try:
+                ok, result = queue.get(timeout=1.0)
+                break
+            except Empty:
+                raise RuntimeError(
+                    f"{fn.__name__} died in a forked child process with exit code "
+                    f"{process.exitcode} before returning"
+                ) from None
+    process.join()
+    if not ok:
+        raise RuntimeError(f"{fn.__name__} failed in a forked child process:\n{result}")
+    if process.exitcode:
+        raise RuntimeError(
+            f"{fn.__name__} exited from a forked child process with exit code "
+            f"{process.exitcode}"
+        )
+    return result
+
+
+def benchmark_metadata() -> dict:
+    """Describe the code and machine a benchmark ran on, so that results written by
+    different commits can be compared."""
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=pathlib.Path(__file__).resolve().parent,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
@@ -4,6 +4,18 @@ from collections import Counter
 
 import numpy as np
 import pytest
+import torch
+
+from ece496b_basics.data import (
+    DocumentIndex,
+    EpochSampler,
+    PrefetchLoader,
+    ShardedCorpus,
+    TokenDataset,
+    get_packed_batch,
+    packing_stats,
+    write_token_file,
+)
 
 from .adapters import run_get_batch
 
@@ -75,3 +87,109 @@ def test_get_batch():
         assert "CUDA error" in str(
             excinfo.value
         ) or "Torch not compiled with CUDA enabled" in str(excinfo.value)
+
+
+@pytest.mark.parametrize("max_token_id", [1000, 2**20])
+def test_token_dataset_get_batch(tmp_path, max_token_id):
+    tokens = np.arange(0, 100) * (max_token_id // 100)
+    write_token_file(tmp_path / "tokens.bin", tokens)
+    dataset = TokenDataset(tmp_path / "tokens.bin")
+    assert dataset.dtype == (np.uint16 if max_token_id < 2**16 else np.uint32)
+    np.testing.assert_array_equal(dataset.tokens, tokens)
+
+    x, y = run_get_batch(
+        dataset=dataset.tokens, batch_size=32, context_length=7, device="cpu"
+    )
+    assert x.dtype == y.dtype == torch.long
+    assert x.shape == y.shape == (32, 7)
+    np.testing.assert_array_equal(x.numpy() + max_token_id // 100, y.numpy())
+
+    np.save(tmp_path / "tokens.npy", tokens.astype(dataset.dtype))
+    np.testing.assert_array_equal(TokenDataset(tmp_path / "tokens.npy").tokens, tokens)
+
+
+def test_prefetch_loader():
+    dataset = np.arange(0, 100)
+    with PrefetchLoader(
+        dataset, batch_size=32, context_length=7, device="cpu", prefetch=2
+    ) as loader:
+        for _, (x, y) in zip(range(10), loader):
+            assert x.shape == y.shape == (32, 7)
+            np.testing.assert_array_equal((x + 1).numpy(), y.numpy())
+        stats = loader.stats()
+    assert stats.batches == 10
+    assert 0 <= stats.starved <= 10
+    assert 0.0 <= stats.starvation_rate <= 1.0
+
+    with pytest.raises(ValueError):
+        next(PrefetchLoader(dataset, batch_size=1, context_length=100, device="cpu"))
+
+
+def test_epoch_sampler_visits_every_window_once():
+    dataset = np.arange(0, 100)
+    context_length = 7
+    sampler = EpochSampler(len(dataset), context_length, seed=0)
+    num_windows = (len(dataset) - 1) // context_length
+    x, y = run_get_batch(dataset, num_windows, context_length, "cpu", sampler=sampler)
+    np.testing.assert_array_equal((x + 1).numpy(), y.numpy())
+    assert sorted(x[:, 0].tolist()) == list(range(0, num_windows * context_length, 7))
+    assert sampler.state_dict()["epoch"] == 1
+
+    x_next, _ = run_get_batch(
+        dataset, num_windows, context_length, "cpu", sampler=sampler
+    )
+    assert sorted(x_next[:, 0].tolist()) == sorted(x[:, 0].tolist())
+    assert not torch.equal(x_next, x)
+
+
+def test_get_packed_batch_segment_ids():
+    eot_id = 0
+    # Documents of lengths 3, 5, 1 and 7, each ended by `eot_id`.
+    dataset = np.array([1, 2, 0, 3, 4, 5, 6, 0, 0, 7, 8, 9, 10, 11, 12, 0])
+    index = DocumentIndex(dataset, eot_id, chunk_size=4)
+    np.testing.assert_array_equal(index.eot_positions, [2, 7, 8, 15])
+    x, y, segment_ids = get_packed_batch(
+        dataset, batch_size=64, context_length=6, device="cpu", document_index=index
+    )
+    assert x.shape == y.shape == segment_ids.shape == (64, 6)
+    for row, row_segments in zip(x.tolist(), segment_ids.tolist()):
+        # A new document starts right after every end-of-text token.
+        expected = np.cumsum([0] + [token == eot_id for token in row[:-1]])
+        assert row_segments == expected.tolist()
+
+    stats = packing_stats(torch.tensor([[0, 0, 1, 1], [0, 0, 0, 0]]))
+    assert stats.documents == 3
+    assert stats.causal_pairs == 20
+    # Row 0 loses the 4 pairs from the second document to the first.
+    assert stats.cross_document_pairs == 4
+    assert stats.cross_document_fraction == 0.2
+    assert stats.padding_efficiency == 8 / 12
+
+
+def test_sharded_corpus_mixture(tmp_path):
+    # Source "a" holds tokens below 1000 in two shards, source "b" tokens above.
+    write_token_file(tmp_path / "a0.bin", np.arange(0, 50))
+    write_token_file(tmp_path / "a1.bin", np.arange(100, 400))
+    write_token_file(tmp_path / "a2.bin", np.arange(500, 503))
+    write_token_file(tmp_path / "b0.bin", np.arange(1000, 1100))
+    corpus = ShardedCorpus(
+        {"a": str(tmp_path / "a*.bin"), "b": [tmp_path / "b0.bin"]},
+        weights={"a": 3, "b": 1},
+        rng=np.random.default_rng(0),
+    )
+    assert len(corpus) == 453
+
+    num_iters = 200
+    from_a = 0
+    for _ in range(num_iters):
+        x, y = corpus.get_batch(batch_size=16, context_length=8, device="cpu")
+        assert x.shape == y.shape == (16, 8)
+        # Every window comes from a single shard, and the 3-token shard is too short.
+        np.testing.assert_array_equal((x + 1).numpy(), y.numpy())
+        assert not ((x >= 500) & (x < 1000)).any()
+        from_a += int((x[:, 0] < 1000).sum())
+    assert abs(from_a / (num_iters * 16) - 0.75) < 0.05
+    assert corpus.tokens_consumed == {
+        "a": from_a * 8,
+        "b": (num_iters * 16 - from_a) * 8,
+    }
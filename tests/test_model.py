@@ -1,9 +1,17 @@
 #!/usr/bin/env python3
 import numpy
+import pytest
 import torch
 import torch.nn.functional as F
 
+from ece496b_basics.model import (
+    TransformerLM,
+    causal_mask,
+    scaled_dot_product_attention,
+)
+
 from .adapters import (
+    run_cross_entropy,
     run_gelu,
     run_multihead_self_attention,
     run_positionwise_feedforward,
@@ -73,6 +81,102 @@ def test_4d_scaled_dot_product_attention():
     )
 
 
+@pytest.mark.parametrize("block_size", [8, 12])
+def test_tiled_scaled_dot_product_attention(block_size):
+    K = torch.load(FIXTURES_PATH / "scaled_dot_product_attention_K.pt")
+    Q = torch.load(FIXTURES_PATH / "scaled_dot_product_attention_Q.pt")
+    V = torch.load(FIXTURES_PATH / "scaled_dot_product_attention_V.pt")
+    mask = torch.load(FIXTURES_PATH / "scaled_dot_product_attention_mask.pt")
+    expected_output = torch.load(
+        FIXTURES_PATH / "scaled_dot_product_attention_expected_output.pt"
+    )
+    actual_output = run_scaled_dot_product_attention(
+        K=K, Q=Q, V=V, mask=mask, pdrop=0.0, block_size=block_size
+    )
+    numpy.testing.assert_allclose(
+        actual_output.detach().numpy(), expected_output.detach().numpy(), atol=1e-6
+    )
+
+    # A mask with singleton dimensions, broadcast over heads and queries.
+    key_mask = torch.rand(K.shape[0], 1, 1, K.shape[-2]) < 0.3
+    key_mask[..., 0] = False
+    numpy.testing.assert_allclose(
+        run_scaled_dot_product_attention(
+            K=K, Q=Q, V=V, mask=key_mask, block_size=block_size
+        ).numpy(),
+        run_scaled_dot_product_attention(K=K, Q=Q, V=V, mask=key_mask).numpy(),
+        atol=1e-6,
+    )
+
+    # Dropout zeroes some probabilities and rescales the others, so that the
+    # output is unbiased.
+    torch.manual_seed(0)
+    ones = torch.ones_like(V)
+    dropped = run_scaled_dot_product_attention(
+        K=K, Q=Q, V=ones, mask=mask, pdrop=0.5, block_size=block_size
+    )
+    assert not torch.allclose(dropped, ones)
+    assert dropped.mean().item() == pytest.approx(1.0, abs=0.05)
+
+
+@pytest.mark.parametrize("q_len", [32, 20])
+def test_tiled_causal_attention(q_len):
+    torch.manual_seed(0)
+    K = torch.load(FIXTURES_PATH / "scaled_dot_product_attention_K.pt")
+    Q = torch.load(FIXTURES_PATH / "scaled_dot_product_attention_Q.pt")[..., -q_len:, :]
+    V = torch.load(FIXTURES_PATH / "scaled_dot_product_attention_V.pt")
+    # Queries are the last q_len positions: query i sits at key position offset + i.
+    causal = causal_mask(q_len, offset=K.shape[-2] - q_len)
+    key_mask = torch.rand(K.shape[0], 1, 1, K.shape[-2]) < 0.3
+    key_mask[..., 0] = False
+    for mask in [None, key_mask]:
+        expected_output = run_scaled_dot_product_attention(
+            K=K, Q=Q, V=V, mask=causal if mask is None else causal | mask
+        )
+        for block_size in [None, 8, 12]:
+            actual_output = run_scaled_dot_product_attention(
+                K=K, Q=Q, V=V, mask=mask, block_size=block_size, causal=True
+            )
+            numpy.testing.assert_allclose(
+                actual_output.numpy(), expected_output.numpy(), atol=1e-6
+            )
+
+
+@pytest.mark.parametrize("causal", [False, True])
+def test_tiled_attention_backward(causal):
+    torch.manual_seed(0)
+    K = torch.randn(2, 3, 29, 8, dtype=torch.float64)
+    Q = torch.randn(2, 3, 13, 8, dtype=torch.float64)
+    V = torch.randn(2, 1, 29, 5, dtype=torch.float64)  # Broadcast over heads.
+    key_mask = torch.rand(2, 1, 1, 29) < 0.3
+    key_mask[..., 0] = False
+    full_mask = key_mask
+    if causal:
+        full_mask = key_mask | causal_mask(13, offset=29 - 13)
+    grad_output = torch.randn(2, 3, 13, 5, dtype=torch.float64)
+
+    def grads(**kwargs):
+        inputs = [x.clone().requires_grad_() for x in (K, Q, V)]
+        (scaled_dot_product_attention(*inputs, **kwargs) * grad_output).sum().backward()
+        return [x.grad for x in inputs]
+
+    expected_grads = grads(mask=full_mask)
+    for actual, expected in zip(
+        grads(mask=key_mask, block_size=6, causal=causal), expected_grads
+    ):
+        numpy.testing.assert_allclose(actual.numpy(), expected.numpy(), atol=1e-12)
+
+    # The backward pass regenerates each tile's dropout mask from the same seed.
+    def dropped(K, Q, V):
+        torch.manual_seed(0)
+        return scaled_dot_product_attention(
+            K, Q, V, pdrop=0.3, block_size=4, causal=causal
+        )
+
+    inputs = tuple(x[0, 0, :10].clone().requires_grad_() for x in (K, Q, V))
+    assert torch.autograd.gradcheck(dropped, inputs)
+
+
 def test_multihead_self_attention():
     reference_weights = torch.load(
         FIXTURES_PATH / "unbatched_multihead_self_attention_weights.pt"
@@ -243,3 +347,178 @@ def test_gelu_matches_pytorch():
     numpy.testing.assert_allclose(
         actual_output.detach().numpy(), expected_output.detach().numpy(), atol=1e-6
     )
+
+
+def test_multihead_self_attention_segment_ids():
+    reference_weights = torch.load(
+        FIXTURES_PATH / "unbatched_multihead_self_attention_weights.pt"
+    )
+    in_features = torch.load(FIXTURES_PATH / "in_features.pt")[:2, :16]
+    segment_ids = torch.tensor([[0] * 5 + [1] * 8 + [2] * 3, [0] * 16])
+    actual_output = run_multihead_self_attention(
+        d_model=64,
+        num_heads=2,
+        attn_pdrop=0.0,
+        weights=reference_weights,
+        in_features=in_features,
+        segment_ids=segment_ids,
+    )
+    # Packed attention must equal attending over each document on its own.
+    for row in range(2):
+        for segment in segment_ids[row].unique():
+            positions = segment_ids[row] == segment
+            expected_output = run_multihead_self_attention(
+                d_model=64,
+                num_heads=2,
+                attn_pdrop=0.0,
+                weights=reference_weights,
+                in_features=in_features[row, positions][None],
+            )
+            numpy.testing.assert_allclose(
+                actual_output[row, positions].detach().numpy(),
+                expected_output[0].detach().numpy(),
+                atol=1e-6,
+            )
+
+
+def _load_transformer_lm(**kwargs) -> TransformerLM:
+    model = TransformerLM(
+        vocab_size=100,
+        context_length=64,
+        d_model=128,
+        num_layers=2,
+        num_heads=2,
+        d_ff=512,
+        **kwargs,
+    )
+    model.load_state_dict(torch.load(FIXTURES_PATH / "transformer_lm_weights.pt"))
+    return model.eval()
+
+
+@pytest.mark.parametrize("attn_block_size", [None, 16])
+def test_transformer_lm_causal_mask_cache(attn_block_size):
+    model = _load_transformer_lm(attn_block_size=attn_block_size)
+    for name in ["in_indices", "in_indices_truncated"]:
+        in_indices = torch.load(FIXTURES_PATH / f"{name}.pt")
+        expected_output = torch.load(
+            FIXTURES_PATH
+            / f"transformer_lm{name[len('in_indices'):]}_expected_output.pt"
+        )
+        with torch.no_grad():
+            actual_output = model(in_indices)
+        numpy.testing.assert_allclose(
+            actual_output.numpy(), expected_output.detach().numpy(), atol=1e-4
+        )
+    # The full-length input sized the cached mask; the truncated one sliced it.
+    expected_cache_len = 0 if attn_block_size is not None else model.context_length
+    for layer in model.layers:
+        assert len(layer.attn.causal_mask_cache) == expected_cache_len
+
+
+@pytest.mark.parametrize("residual_pdrop", [0.0, 0.1])
+def test_transformer_lm_activation_checkpointing(residual_pdrop):
+    in_indices = torch.load(FIXTURES_PATH / "in_indices.pt")
+
+    def gradients(checkpoint_layers):
+        model = _load_transformer_lm(
+            residual_pdrop=residual_pdrop, checkpoint_layers=checkpoint_layers
+        ).train()
+        torch.manual_seed(0)
+        model(in_indices).logsumexp(dim=-1).mean().backward()
+        return {name: param.grad for name, param in model.named_parameters()}
+
+    expected = gradients(())
+    for checkpoint_layers in [[0], [0, 1]]:
+        actual = gradients(checkpoint_layers)
+        assert actual.keys() == expected.keys()
+        for name, grad in expected.items():
+            assert torch.equal(actual[name], grad), name
+
+    with pytest.raises(ValueError):
+        _load_transformer_lm(checkpoint_layers=[2])
+
+
+def test_transformer_lm_mixed_precision():
+    in_indices = torch.load(FIXTURES_PATH / "in_indices.pt")
+    expected_output = torch.load(FIXTURES_PATH / "transformer_lm_expected_output.pt")
+    model = _load_transformer_lm(autocast_dtype=torch.bfloat16)
+    actual_output = model(in_indices)
+    assert actual_output.dtype == torch.bfloat16
+    numpy.testing.assert_allclose(
+        actual_output.detach().float().numpy(),
+        expected_output.detach().numpy(),
+        atol=1.0,
+        rtol=1e-2,
+    )
+
+    # The loss is reduced in float32, and the master weights and their gradients
+    # stay float32.
+    loss = run_cross_entropy(
+        actual_output[:, :-1].flatten(0, 1), in_indices[:, 1:].flatten()
+    )
+    expected_loss = F.cross_entropy(
+        expected_output[:, :-1].flatten(0, 1), in_indices[:, 1:].flatten()
+    )
+    assert loss.dtype == torch.float32
+    assert loss.item() == pytest.approx(expected_loss.item(), rel=1e-3)
+    loss.backward()
+    for param in model.parameters():
+        assert param.dtype == param.grad.dtype == torch.float32
+
+
+def test_transformer_lm_kv_cache_matches_full_forward():
+    model = _load_transformer_lm()
+    in_indices = torch.load(FIXTURES_PATH / "in_indices.pt")
+    with torch.no_grad():
+        expected_output = model(in_indices)
+        kv_caches = model.init_kv_caches(batch_size=in_indices.shape[0])
+        # A prompt in one pass, then one token per step.
+        outputs = [model(in_indices[:, :5], kv_caches=kv_caches)]
+        for position in range(5, in_indices.shape[1]):
+            outputs.append(
+                model(in_indices[:, position : position + 1], kv_caches=kv_caches)
+            )
+    numpy.testing.assert_allclose(
+        torch.cat(outputs, dim=1).numpy(), expected_output.numpy(), atol=1e-4
+    )
+
+
+def test_transformer_lm_generate_greedy():
+    model = _load_transformer_lm()
+    prompt = torch.load(FIXTURES_PATH / "in_indices.pt")[0, :10]
+    generated = model.generate(prompt, max_new_tokens=20, temperature=0.0)
+    sequence = prompt
+    with torch.no_grad():
+        for _ in range(20):
+            next_id = model(sequence[None])[0, -1].argmax()
+            sequence = torch.cat([sequence, next_id[None]])
+    assert generated.tolist() == sequence[10:].tolist()
+
+    # Generation stops once the context is full.
+    assert len(model.generate(prompt, max_new_tokens=100)) == 64 - 10 + 1
+
+
+def test_transformer_lm_generate_batch():
+    model = _load_transformer_lm()
+    in_indices = torch.load(FIXTURES_PATH / "in_indices.pt")
+    prompts = [in_indices[0, :10], in_indices[1, :3], in_indices[2, :60]]
+    expected = [
+        model.generate(prompt, max_new_tokens=8, temperature=0.0) for prompt in prompts
+    ]
+    generated = model.generate_batch(prompts, max_new_tokens=8, temperature=0.0)
+    # The third prompt runs out of context after 64 - 60 + 1 tokens.
+    assert [len(ids) for ids in generated] == [8, 8, 5]
+    for ids, expected_ids in zip(generated, expected):
+        assert ids.tolist() == expected_ids.tolist()
+
+    # Rows stop independently at the end-of-text token.
+    eos_id = expected[0][2].item()
+    generated = model.generate_batch(
+        prompts, max_new_tokens=8, temperature=0.0, eos_id=eos_id
+    )
+    for ids, expected_ids in zip(generated, expected):
+        expected_ids = expected_ids.tolist()
+        if eos_id in expected_ids:
+            expected_ids = expected_ids[: expected_ids.index(eos_id) + 1]
+        assert ids.tolist() == expected_ids
+    assert len(generated[0]) < 8
@@ -4,7 +4,14 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-from .adapters import get_adamw_cls, run_load_checkpoint, run_save_checkpoint
+from ece496b_basics.data import EpochSampler
+
+from .adapters import (
+    get_adamw_cls,
+    run_get_batch,
+    run_load_checkpoint,
+    run_save_checkpoint,
+)
 
 
 class _TestNet(nn.Module):
@@ -124,3 +131,30 @@ def test_checkpointing(tmp_path):
         )
     # compare the optimizer state dicts
     assert are_optimizers_equal(original_optimizer_state, new_optimizer_state)
+
+
+def test_checkpointing_restores_sampler(tmp_path):
+    dataset = numpy.arange(0, 1000)
+    context_length = 8
+    model = _TestNet()
+    optimizer = get_adamw_cls()(model.parameters(), lr=1e-3)
+    sampler = EpochSampler(len(dataset), context_length, seed=3)
+    for _ in range(20):
+        run_get_batch(dataset, 16, context_length, "cpu", sampler=sampler)
+    run_save_checkpoint(
+        model, optimizer, iteration=20, out=tmp_path / "ckpt.pt", sampler=sampler
+    )
+    # Run past the end of the epoch so the resumed run has to regenerate the order.
+    expected = [
+        run_get_batch(dataset, 16, context_length, "cpu", sampler=sampler)[0]
+        for _ in range(10)
+    ]
+
+    resumed = EpochSampler(len(dataset), context_length, seed=0)
+    iteration = run_load_checkpoint(
+        tmp_path / "ckpt.pt", model, optimizer, sampler=resumed
+    )
+    assert iteration == 20
+    for expected_x in expected:
+        x, _ = run_get_batch(dataset, 16, context_length, "cpu", sampler=resumed)
+        assert torch.equal(x, expected_x)
@@ -4,13 +4,16 @@ from __future__ import annotations
 
 import json
 import os
+import random
 import resource
 import sys
 from typing import Optional
 
+import numpy
 import psutil
 import pytest
 import tiktoken
+import torch
 
 from .adapters import get_tokenizer
 from .common import FIXTURES_PATH, gpt2_bytes_to_unicode
@@ -269,6 +272,41 @@ def test_overlapping_special_tokens():
     assert tokenizer.decode(ids) == test_string
 
 
+def test_many_special_tokens():
+    control_tokens = [f"<|control_{i}|>" for i in range(500)]
+    tokenizer = get_tokenizer_from_vocab_merges_path(
+        vocab_path=VOCAB_PATH,
+        merges_path=MERGES_PATH,
+        special_tokens=control_tokens + ["<|endoftext|>", "<|endoftext|><|endoftext|>"],
+    )
+    test_string = (
+        "<|control_1|><|control_12|> Hello<|control_123|><|control_|"
+        "<|endoftext|><|endoftext|>"
+    )
+    ids = tokenizer.encode(test_string)
+    tokenized_string = [tokenizer.decode([x]) for x in ids]
+    assert tokenized_string[:2] == ["<|control_1|>", "<|control_12|>"]
+    assert "<|control_123|>" in tokenized_string
+    assert "<|control_" not in tokenized_string
+    assert tokenized_string[-1] == "<|endoftext|><|endoftext|>"
+    assert tokenizer.decode(ids) == test_string
+
+
+def test_pretoken_cache_info():
+    tokenizer = get_tokenizer_from_vocab_merges_path(
+        vocab_path=VOCAB_PATH,
+        merges_path=MERGES_PATH,
+    )
+    test_string = "the cat and the dog and the bird"
+    ids = tokenizer.encode(test_string)
+    info = tokenizer.cache_info()
+    # "the" and " the" / " and" repeat, so some pre-tokens are served from the cache.
+    assert info.hits > 0
+    assert info.currsize == info.misses
+    assert tokenizer.encode(test_string) == ids
+    assert tokenizer.cache_info().hit_rate > info.hit_rate
+
+
 def test_address_roundtrip():
     tokenizer = get_tokenizer_from_vocab_merges_path(
         vocab_path=VOCAB_PATH,
@@ -357,6 +395,31 @@ def test_tinystories_matches_tiktoken():
     assert reference_tokenizer.decode(reference_ids) == corpus_contents
 
 
+def test_encode_batch_matches_encode():
+    tokenizer = get_tokenizer_from_vocab_merges_path(
+        vocab_path=VOCAB_PATH, merges_path=MERGES_PATH, special_tokens=["<|endoftext|>"]
+    )
+    with open(FIXTURES_PATH / "tinystories_sample.txt") as f:
+        documents = f.read().split("<|endoftext|>")
+    expected_ids = [tokenizer.encode(document) for document in documents]
+    assert tokenizer.encode_batch(documents, num_workers=2) == expected_ids
+
+
+def test_encode_file_matches_encode(tmp_path):
+    tokenizer = get_tokenizer_from_vocab_merges_path(
+        vocab_path=VOCAB_PATH, merges_path=MERGES_PATH, special_tokens=["<|endoftext|>"]
+    )
+    corpus_path = FIXTURES_PATH / "tinystories_sample.txt"
+    with open(corpus_path) as f:
+        expected_ids = tokenizer.encode(f.read())
+    out_path = tmp_path / "tinystories_sample.npy"
+    num_tokens = tokenizer.encode_file(corpus_path, out_path, num_workers=3)
+    ids = numpy.load(out_path)
+    assert num_tokens == len(expected_ids)
+    assert ids.dtype == numpy.uint16
+    assert ids.tolist() == expected_ids
+
+
 def test_encode_iterable_tinystories_sample_roundtrip():
     tokenizer = get_tokenizer_from_vocab_merges_path(
         vocab_path=VOCAB_PATH,
@@ -392,6 +455,104 @@ def test_encode_iterable_tinystories_matches_tiktoken():
     assert reference_tokenizer.decode(reference_ids) == corpus_contents
 
 
+def test_decode_array_inputs():
+    tokenizer = get_tokenizer_from_vocab_merges_path(
+        vocab_path=VOCAB_PATH,
+        merges_path=MERGES_PATH,
+    )
+    with open(FIXTURES_PATH / "german.txt") as f:
+        corpus_contents = f.read()
+    ids = tokenizer.encode(corpus_contents)
+    assert tokenizer.decode(numpy.array(ids)) == corpus_contents
+    assert tokenizer.decode(torch.tensor(ids)) == corpus_contents
+
+
+@pytest.mark.parametrize("invalid_id", [-1, 300, 258])
+def test_decode_rejects_unknown_ids(invalid_id):
+    # Id 258 is a gap: the vocab skips from 257 to 259.
+    vocab = {i: bytes([i]) for i in range(256)}
+    vocab.update({256: b"ab", 257: b"abc", 259: b"cd"})
+    tokenizer = get_tokenizer(vocab, [(b"a", b"b"), (b"ab", b"c"), (b"c", b"d")])
+    for length in (1, 100):
+        ids = [97] * (length - 1) + [invalid_id]
+        for container in (list, numpy.array, torch.tensor):
+            with pytest.raises(KeyError):
+                tokenizer.decode(container(ids))
+
+
+def test_save_load_roundtrip(tmp_path):
+    tokenizer = get_tokenizer_from_vocab_merges_path(
+        vocab_path=VOCAB_PATH,
+        merges_path=MERGES_PATH,
+        special_tokens=["<|endoftext|>", "<|endoftext|><|endoftext|>"],
+    )
+    tokenizer.save(tmp_path / "tokenizer.bin")
+    loaded = type(tokenizer).load(tmp_path / "tokenizer.bin")
+    assert loaded.vocab == tokenizer.vocab
+    assert loaded.merges == tokenizer.merges
+    assert loaded.special_ids == tokenizer.special_ids
+    test_string = "Héllò hòw <|endoftext|><|endoftext|> are ü? 🙃<|endoftext|>"
+    ids = loaded.encode(test_string)
+    assert ids == tokenizer.encode(test_string)
+    assert loaded.decode(ids) == test_string
+
+
+def test_decode_stream_never_splits_characters():
+    tokenizer = get_tokenizer_from_vocab_merges_path(
+        vocab_path=VOCAB_PATH,
+        merges_path=MERGES_PATH,
+    )
+    test_string = "Héllò hôw are ü? 🙃 日本語"
+    ids = tokenizer.encode(test_string)
+    pieces = list(tokenizer.decode_stream(iter(ids)))
+    assert "".join(pieces) == test_string
+    assert not any("\ufffd" in piece for piece in pieces)
+
+
+def test_encode_iterable_chunk_boundaries():
+    tokenizer = get_tokenizer_from_vocab_merges_path(
+        vocab_path=VOCAB_PATH,
+        merges_path=MERGES_PATH,
+        special_tokens=["<|endoftext|>", "<|endoftext|><|endoftext|>"],
+    )
+    with open(FIXTURES_PATH / "tinystories_sample.txt") as f:
+        corpus_contents = f.read() + "\n\n  <|endoftext|><|endoftext|><|endoftext|>"
+    expected_ids = tokenizer.encode(corpus_contents)
+    # Chunks that split pre-tokens, whitespace runs and special tokens.
+    for chunk_size in (1, 7, 64):
+        chunks = [
+            corpus_contents[i : i + chunk_size]
+            for i in range(0, len(corpus_contents), chunk_size)
+        ]
+        assert list(tokenizer.encode_iterable(chunks)) == expected_ids
+
+    # Contractions split after their apostrophe or first letter.
+    for parts in (["I'l", "l say"], ["we'v", "e been"], ["they'", "re here"]):
+        assert list(tokenizer.encode_iterable(parts)) == tokenizer.encode(
+            "".join(parts)
+        )
+    rng = random.Random(0)
+    for _ in range(200):
+        text = "".join(rng.choices("I'lvrestd !\n", k=20))
+        assert list(tokenizer.encode_iterable(text)) == tokenizer.encode(text)
+
+    # A special token cut off at the chunk end overlaps a shorter one that is
+    # already complete; the longer one must win, as in `encode`.
+    overlapping = get_tokenizer_from_vocab_merges_path(
+        vocab_path=VOCAB_PATH,
+        merges_path=MERGES_PATH,
+        special_tokens=["<|endoftext|>", "endo"],
+    )
+    for parts in (["x<|endo", "ftext|>"], ["x<|endo", "ft", "ext|> endo y"]):
+        assert list(overlapping.encode_iterable(parts)) == overlapping.encode(
+            "".join(parts)
+        )
+
+    batches = list(tokenizer.encode_iterable_batched(chunks, batch_size=100))
+    assert all(len(batch) == 100 for batch in batches[:-1])
+    assert numpy.concatenate(batches).tolist() == expected_ids
+
+
 @pytest.mark.skipif(
     not sys.platform.startswith("linux"),
     reason="rlimit support for non-linux systems is spotty.",
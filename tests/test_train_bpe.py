@@ -1,6 +1,13 @@
 #!/usr/bin/env python3
 import json
+import os
 import time
+from collections import Counter
+
+import pytest
+
+import ece496b_basics.train_bpe as train_bpe_module
+from ece496b_basics.pretoken_cache import PretokenCache
 
 from .adapters import run_train_bpe
 from .common import FIXTURES_PATH, gpt2_bytes_to_unicode
@@ -63,3 +70,191 @@ def test_train_bpe():
     # have been constructed differently, we'll make sure that the vocab keys and values match)
     assert set(vocab.keys()) == set(reference_vocab.keys())
     assert set(vocab.values()) == set(reference_vocab.values())
+
+
+def test_train_bpe_parallel_matches_serial():
+    # The TinyStories sample contains <|endoftext|>, so it is actually chunked.
+    input_path = FIXTURES_PATH / "tinystories_sample.txt"
+    serial_vocab, serial_merges = run_train_bpe(
+        input_path=input_path,
+        vocab_size=300,
+        special_tokens=["<|endoftext|>"],
+        num_workers=1,
+    )
+    parallel_vocab, parallel_merges = run_train_bpe(
+        input_path=input_path,
+        vocab_size=300,
+        special_tokens=["<|endoftext|>"],
+        num_workers=4,
+    )
+    assert serial_merges == parallel_merges
+    assert serial_vocab == parallel_vocab
+
+
+def test_train_bpe_compact_matches_default():
+    input_path = FIXTURES_PATH / "corpus.en"
+    vocab, merges = run_train_bpe(
+        input_path=input_path,
+        vocab_size=500,
+        special_tokens=["<|endoftext|>"],
+    )
+    compact_vocab, compact_merges = run_train_bpe(
+        input_path=input_path,
+        vocab_size=500,
+        special_tokens=["<|endoftext|>"],
+        compact=True,
+    )
+    assert compact_merges == merges
+    assert compact_vocab == vocab
+
+
+def test_train_bpe_timings():
+    timings = {}
+    merge_latencies = []
+    _, merges = run_train_bpe(
+        input_path=FIXTURES_PATH / "corpus.en",
+        vocab_size=500,
+        special_tokens=["<|endoftext|>"],
+        timings=timings,
+        merge_latencies=merge_latencies,
+    )
+    # The corpus is only hashed for snapshots and the pre-token cache.
+    assert set(timings) == {
+        "pretokenization",
+        "initial_pair_counting",
+        "merge_loop",
+        "checkpointing",
+    }
+    assert len(merge_latencies) == len(merges)
+    assert sum(merge_latencies) <= timings["merge_loop"]
+
+
+def test_train_bpe_resume_from_snapshot(tmp_path, monkeypatch):
+    input_path = FIXTURES_PATH / "corpus.en"
+    snapshot_path = tmp_path / "bpe_snapshot.pkl"
+    vocab, merges = run_train_bpe(
+        input_path=input_path,
+        vocab_size=500,
+        special_tokens=["<|endoftext|>"],
+    )
+
+    # Crash after 110 merges, so the last snapshot is the periodic one at 100.
+    merge = train_bpe_module.PairIndex.merge
+    num_merges = 0
+
+    def crashing_merge(self, pair, new_id):
+        nonlocal num_merges
+        if num_merges == 110:
+            raise RuntimeError("simulated crash")
+        num_merges += 1
+        merge(self, pair, new_id)
+
+    with monkeypatch.context() as patch:
+        patch.setattr(train_bpe_module.PairIndex, "merge", crashing_merge)
+        with pytest.raises(RuntimeError, match="simulated crash"):
+            run_train_bpe(
+                input_path=input_path,
+                vocab_size=500,
+                special_tokens=["<|endoftext|>"],
+                checkpoint_path=snapshot_path,
+                checkpoint_every=25,
+            )
+
+    def counting_merge(self, pair, new_id):
+        nonlocal num_merges
+        num_merges += 1
+        merge(self, pair, new_id)
+
+    num_merges = 0
+    with monkeypatch.context() as patch:
+        patch.setattr(train_bpe_module.PairIndex, "merge", counting_merge)
+        resumed_vocab, resumed_merges = run_train_bpe(
+            input_path=input_path,
+            vocab_size=500,
+            special_tokens=["<|endoftext|>"],
+            resume_from=snapshot_path,
+        )
+    assert num_merges == len(merges) - 100
+    assert resumed_merges == merges
+    assert resumed_vocab == vocab
+
+    # A finished run can be resumed with a larger vocab size.
+    _, partial_merges = run_train_bpe(
+        input_path=input_path,
+        vocab_size=350,
+        special_tokens=["<|endoftext|>"],
+        checkpoint_path=snapshot_path,
+    )
+    assert partial_merges == merges[: len(partial_merges)]
+    resumed_vocab, resumed_merges = run_train_bpe(
+        input_path=input_path,
+        vocab_size=500,
+        special_tokens=["<|endoftext|>"],
+        resume_from=snapshot_path,
+    )
+    assert resumed_merges == merges
+    assert resumed_vocab == vocab
+
+
+def test_train_bpe_resume_rejects_other_corpus(tmp_path):
+    input_path = tmp_path / "corpus.txt"
+    input_path.write_text("low lower lowest " * 50)
+    snapshot_path = tmp_path / "bpe_snapshot.pkl"
+    run_train_bpe(
+        input_path=input_path,
+        vocab_size=270,
+        special_tokens=["<|endoftext|>"],
+        checkpoint_path=snapshot_path,
+    )
+    # Same size, different contents.
+    input_path.write_text("new newer newest " * 50)
+    with pytest.raises(ValueError):
+        run_train_bpe(
+            input_path=input_path,
+            vocab_size=280,
+            special_tokens=["<|endoftext|>"],
+            resume_from=snapshot_path,
+        )
+
+
+def test_train_bpe_pretoken_cache(tmp_path, monkeypatch):
+    input_path = FIXTURES_PATH / "corpus.en"
+    cache_dir = tmp_path / "pretoken_cache"
+    vocab, merges = run_train_bpe(
+        input_path=input_path,
+        vocab_size=500,
+        special_tokens=["<|endoftext|>"],
+        pretoken_cache_dir=cache_dir,
+    )
+    assert len(list(cache_dir.iterdir())) == 1
+
+    # A cache hit must not pre-tokenize the corpus again.
+    def fail(*args, **kwargs):
+        raise AssertionError("pre-tokenized despite a cache hit")
+
+    monkeypatch.setattr(train_bpe_module, "count_pretokens", fail)
+    cached_vocab, cached_merges = run_train_bpe(
+        input_path=input_path,
+        vocab_size=500,
+        special_tokens=["<|endoftext|>"],
+        pretoken_cache_dir=cache_dir,
+    )
+    assert cached_merges == merges
+    assert cached_vocab == vocab
+
+
+def test_pretoken_cache_evicts_least_recently_used(tmp_path):
+    cache = PretokenCache(tmp_path, max_bytes=2**20)
+    counts = Counter({" low": 5, " lower": 2, " newest": 6})
+    for mtime, key in enumerate(["a", "b", "c"]):
+        cache.put(key, counts)
+        os.utime(tmp_path / f"{key}.ptc", (mtime, mtime))
+    assert cache.get("a") == counts  # Now the most recently used entry.
+    entry_size = os.path.getsize(tmp_path / "a.ptc")
+
+    cache.max_bytes = 2 * entry_size
+    cache.evict()
+    assert sorted(os.listdir(tmp_path)) == ["a.ptc", "c.ptc"]
+    cache.put("d", counts)
+    assert sorted(os.listdir(tmp_path)) == ["a.ptc", "d.ptc"]
+    assert cache.get("a") == counts